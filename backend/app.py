@@ -1,26 +1,47 @@
 import os
+from resources import (RESOURCES, set_thread_env, pin_process, apply_runtime_threads, apply_ort_threads,
+                       inference_worker_init, cpu_count)
+set_thread_env(RESOURCES)  # must run before numpy/torch/TensorFlow size their thread pools
+pin_process(RESOURCES)  # likewise, so the pools they create inherit the configured cores
 import cv2
 import numpy as np
-import tempfile
 from ultralytics import YOLO
 from insightface.app import FaceAnalysis
-from feat import Detector
+from feat.emo_detectors.ResMaskNet.resmasknet_test import ResMaskNet
+from feat.utils import FEAT_EMOTION_COLUMNS
 # import tensorflow as tf
 from tensorflow.keras.models import load_model  # Use tensorflow.keras for compatibility
 from tensorflow.keras.preprocessing.image import img_to_array
-from PIL import Image
 import math
+import time
+import asyncio
 import logging
-from fastapi import FastAPI, WebSocket, UploadFile, File, HTTPException
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from fastapi import FastAPI, Request, WebSocket, UploadFile, File, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import FileResponse, JSONResponse, StreamingResponse
+import io
+import json
+import zipfile
 import base64
 import colorsys
+import hashlib
+import re
+import uuid
 import torch
 import torchvision
 import torchvision.transforms as transforms
+from frame_cache import FrameCache, DecodedFrames, FRAME_CACHE_DIR, FRAME_CACHE_MAX_BYTES
+from load_governor import LoadGovernor, QUALITY_LEVELS
+from scheduler import FairScheduler
+from rendering import VideoRenderWriter, prune_rendered, RENDER_DIR
+from profiling import (PROFILING_ENABLED, PROFILERS, PROFILE_DIR, Trace, TraceStore, is_admin, span, profiled,
+                       sample_stacks, write_folded)
 
 # Configure logging
-logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
+logging.basicConfig(level=os.environ.get("LOG_LEVEL", "DEBUG").upper(), format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
 app = FastAPI()
@@ -36,6 +57,7 @@ app.add_middleware(
 os.environ["INSIGHTFACE_HOME"] = "D:/Software_Development/face_project"  # Adjust if needed for server environment
 
 # ================== Load Models ==================
+apply_runtime_threads(RESOURCES)
 try:
     logger.debug("Loading YOLO models...")
 
@@ -47,15 +69,12 @@ try:
 
     # InsightFace (for gender, landmarks)
     insight_app = FaceAnalysis(name="buffalo_l", providers=['CPUExecutionProvider'])
+    apply_ort_threads(insight_app, RESOURCES)
     insight_app.prepare(ctx_id=0, det_size=(640, 640))
 
-    # Py-Feat Emotion Detector
-    emotion_detector = Detector(
-        face_model="retinaface",
-        landmark_model="mobilenet",
-        au_model="xgb",
-        emotion_model="resmasknet"
-    )
+    # Py-Feat ResMaskNet emotion network only (faces are already detected and aligned upstream)
+    emotion_net = ResMaskNet(device="cpu").model
+    emotion_net.eval()
 
     # Age Model (ResNet50 custom)
     AGE_MODEL_PATH = "age-detection-resnet50-model/best_model.h5"
@@ -88,6 +107,35 @@ object_class_names = object_model.names  # Use YOLO's actual trained class names
 object_colors = {i: tuple(int(x * 255) for x in colorsys.hsv_to_rgb(i / 20.0, 0.7, 0.9)) for i in range(20)}
 face_color = (0, 255, 0)
 
+# Video sampling
+VIDEO_SAMPLE_STRIDE = 5  # Run detectors on every Nth frame
+HAR_CLIP_LEN = 16  # Frames per R(2+1)D clip
+FUSED_ANALYSES = ("object", "face", "har")
+
+# Video frames are scaled during decode (and stored in the frame cache) to this longest side
+DECODE_MAX_SIDE = {"object": 640, "face": 1280, "har": 320, "fused": 1280}
+RENDER_MAX_SIDE = 1280  # Annotated output videos are rendered at this longest side
+os.makedirs(RENDER_DIR, exist_ok=True)
+frame_cache = FrameCache(FRAME_CACHE_DIR, FRAME_CACHE_MAX_BYTES) if FRAME_CACHE_MAX_BYTES > 0 else None
+
+# Multi-image batch detection: uploads decode in parallel, then go through YOLO in same-shape batches
+DETECT_BATCH_SIZE = int(os.environ.get("DETECT_BATCH_SIZE", "8"))  # images per YOLO call
+DETECT_BATCH_MAX_FILES = int(os.environ.get("DETECT_BATCH_MAX_FILES", "500"))
+DETECT_BATCH_MAX_BYTES = int(os.environ.get("DETECT_BATCH_MAX_BYTES", str(1024 ** 3)))  # image bytes per request, as read
+UPLOAD_CHUNK_BYTES = 1024 ** 2  # uploads and zip entries are read in chunks so an oversized one stops at the cap
+DETECT_BATCH_PREFETCH = 4 * DETECT_BATCH_SIZE  # decoded images held ahead of inference per request
+IMAGE_EXTS = (".jpg", ".jpeg", ".png", ".bmp", ".webp")
+ZIP_CONTENT_TYPES = ("application/zip", "application/x-zip-compressed")
+decode_pool = ThreadPoolExecutor(max_workers=max(1, min(4, cpu_count())), thread_name_prefix="image-decode")
+
+# Load-adaptive quality; every model call goes through the fair-share scheduler,
+# so calls waiting for their turn show up as queue depth
+load_governor = LoadGovernor()
+scheduler = FairScheduler(worker_init=inference_worker_init(RESOURCES))
+
+# Admin-only profiling (set PROFILING_TOKEN to enable); request traces are written to PROFILE_DIR
+trace_store = TraceStore(PROFILE_DIR) if PROFILING_ENABLED else None
+
 # Transformation for HAR model
 video_transform = transforms.Compose([
     transforms.Resize((112, 112)),
@@ -98,6 +146,76 @@ video_transform = transforms.Compose([
 ])
 
 # ================== Utilities / Helpers ==================
+def client_key(conn):
+    # Explicit client id if the app sends one; otherwise the peer address (host:port per websocket session)
+    client_id = conn.headers.get("x-client-id")
+    if client_id:
+        return client_id
+    if conn.client is None:
+        return "unknown"
+    return f"{conn.client.host}:{conn.client.port}" if conn.scope["type"] == "websocket" else conn.client.host
+
+def run_scheduled(client_id, request_class, mode, fn, *args, **kwargs):
+    # The "inference" span's self time is the wait for a scheduler slot
+    with load_governor.track(), span("inference"):
+        return scheduler.submit(client_id, request_class, mode, profiled(fn), *args, **kwargs).result()
+
+async def run_inference(client_id, request_class, mode, fn, *args, **kwargs):
+    with load_governor.track(), span("inference"):
+        return await asyncio.wrap_future(scheduler.submit(client_id, request_class, mode, profiled(fn), *args, **kwargs))
+
+def require_admin(request):
+    if not PROFILING_ENABLED:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not is_admin(request):
+        raise HTTPException(status_code=403, detail="Admin token required")
+
+def decode_image(contents):
+    with span("decode"):
+        return cv2.imdecode(np.frombuffer(contents, np.uint8), cv2.IMREAD_COLOR)
+
+def json_response(payload):
+    with span("serialize"):
+        return JSONResponse(payload)
+
+def letterbox_tensor(frame, imgsz=640, stride=32):
+    # Same resize/pad as Ultralytics' LetterBox so the tensor can be fed to any YOLO model directly
+    h, w = frame.shape[:2]
+    r = min(imgsz / h, imgsz / w)
+    new_w, new_h = int(round(w * r)), int(round(h * r))
+    pad_w = (math.ceil(new_w / stride) * stride - new_w) / 2.0
+    pad_h = (math.ceil(new_h / stride) * stride - new_h) / 2.0
+    if (new_w, new_h) != (w, h):
+        frame = cv2.resize(frame, (new_w, new_h), interpolation=cv2.INTER_LINEAR)
+    top, bottom = int(round(pad_h - 0.1)), int(round(pad_h + 0.1))
+    left, right = int(round(pad_w - 0.1)), int(round(pad_w + 0.1))
+    padded = cv2.copyMakeBorder(frame, top, bottom, left, right, cv2.BORDER_CONSTANT, value=(114, 114, 114))
+    chw = np.ascontiguousarray(padded[..., ::-1].transpose(2, 0, 1))  # BGR HWC -> RGB CHW
+    tensor = torch.from_numpy(chw).float().div_(255.0).unsqueeze(0)
+    return tensor, r, (left, top)
+
+def predict_boxes(frame, model, prepared=None, imgsz=640):
+    if prepared is None:
+        results = model.predict(frame, conf=0.5, imgsz=imgsz)
+    else:
+        results = model.predict(prepared[0], conf=0.5)
+    return result_boxes(results[0], frame.shape, prepared)
+
+def result_boxes(result, frame_shape, prepared=None):
+    h_img, w_img = frame_shape[:2]
+    ratio, (pad_x, pad_y) = (1.0, (0, 0)) if prepared is None else prepared[1:]
+    boxes = []
+    for box in result.boxes:
+        x1, y1, x2, y2 = (float(v) for v in box.xyxy[0])
+        if prepared is not None:
+            # Map letterboxed coordinates back onto the source frame
+            x1 = min(max((x1 - pad_x) / ratio, 0), w_img)
+            x2 = min(max((x2 - pad_x) / ratio, 0), w_img)
+            y1 = min(max((y1 - pad_y) / ratio, 0), h_img)
+            y2 = min(max((y2 - pad_y) / ratio, 0), h_img)
+        boxes.append((int(x1), int(y1), int(x2), int(y2), float(box.conf[0]), int(box.cls[0])))
+    return boxes
+
 def expand_box(box, scale, img_w, img_h):
     x1, y1, x2, y2 = box
     cx = (x1 + x2) / 2.0
@@ -185,7 +303,7 @@ def align_and_extract(img, matched_face, yolo_box, expand_scale=1.25):
         logger.debug(f"align_and_extract (fallback) failed: {e}")
         return None
 
-def predict_age(face_bgr):
+def predict_age(face_bgr, tta=True):
     if face_bgr is None or face_bgr.size == 0:
         return "N/A"
     try:
@@ -193,7 +311,7 @@ def predict_age(face_bgr):
         if min(h, w) < 32:
             return "N/A"
 
-        crops = [face_bgr, cv2.flip(face_bgr, 1)]
+        crops = [face_bgr, cv2.flip(face_bgr, 1)] if tta else [face_bgr]
         preds = []
 
         for c in crops:
@@ -230,193 +348,628 @@ def predict_gender_from_matched_face(matched_face, best_iou):
         logger.debug(f"predict_gender_from_matched_face failed: {e}")
         return "N/A", 0.0
 
-def predict_emotion(face_bgr):
-    if face_bgr is None or face_bgr.size == 0:
-        return "Unknown", 0.0
+def emotion_batch_tensor(faces_bgr, size=224):
+    # Same input ResMaskNet sees inside Py-Feat: 3-channel grayscale, 224x224, scaled to [0, 1]
+    batch = np.empty((len(faces_bgr), 3, size, size), dtype=np.float32)
+    for i, face_bgr in enumerate(faces_bgr):
+        gray = cv2.cvtColor(face_bgr, cv2.COLOR_BGR2GRAY)
+        batch[i] = cv2.resize(gray, (size, size), interpolation=cv2.INTER_LINEAR)
+    batch *= 1.0 / 255.0
+    return torch.from_numpy(batch)
+
+def predict_emotions(faces_bgr):
+    results = [("Unknown", 0.0)] * len(faces_bgr)
+    valid = [i for i, f in enumerate(faces_bgr) if f is not None and f.size > 0 and min(f.shape[:2]) >= 48]
+    if not valid:
+        return results
     try:
-        h, w = face_bgr.shape[:2]
-        if min(h, w) < 48:
-            return "Unknown", 0.0
-
-        face_rgb = cv2.cvtColor(face_bgr, cv2.COLOR_BGR2RGB)
-        pil_img = Image.fromarray(face_rgb)
-
-        try:
-            result = emotion_detector.detect_image(pil_img)
-        except Exception:
-            tmpf = None
-            try:
-                tmp = tempfile.NamedTemporaryFile(delete=False, suffix=".jpg")
-                tmpf = tmp.name
-                tmp.close()
-                cv2.imwrite(tmpf, face_bgr)
-                result = emotion_detector.detect_image(tmpf)
-            finally:
-                if tmpf is not None and os.path.exists(tmpf):
-                    try:
-                        os.remove(tmpf)
-                    except Exception:
-                        pass
-
-        if result is not None and hasattr(result, "emotions") and not result.emotions.empty:
-            emotion = result.emotions.iloc[0].idxmax()
-            confidence = float(result.emotions.iloc[0].max())
+        with torch.no_grad():
+            probs = torch.softmax(emotion_net(emotion_batch_tensor([faces_bgr[i] for i in valid])), dim=1).numpy()
+        for i, p in zip(valid, probs):
+            idx = int(np.argmax(p))
+            confidence = float(p[idx])
             if confidence < 0.30:
-                return "Unknown", confidence
-            return emotion, confidence
-        else:
-            return "Unknown", 0.0
+                results[i] = ("Unknown", confidence)
+            else:
+                results[i] = (FEAT_EMOTION_COLUMNS[idx], confidence)
     except Exception as e:
         logger.debug(f"Emotion prediction failed: {e}")
-        return "Unknown", 0.0
+    return results
 
 # ================== Frame Processing ==================
-def process_frame(frame, model, mode):
+def process_frame(frame, model, mode, prepared=None, quality=None):
+    quality = quality or QUALITY_LEVELS[0]
+    
+    logger.debug("Processing frame in %s mode", mode)
+    with span("yolo"):
+        boxes = predict_boxes(frame, model, prepared, imgsz=quality["imgsz"])
+    return build_detections(frame, boxes, mode, quality)
+
+def predict_batch_boxes(frames, model, prepared):
+    # One YOLO call over letterboxed tensors of identical shape
+    logger.debug("Predicting boxes for a batch of %d frames", len(frames))
+    with span("yolo"):
+        results = model.predict(torch.cat([p[0] for p in prepared]), conf=0.5)
+    return [result_boxes(result, frame.shape, p) for frame, result, p in zip(frames, results, prepared)]
+
+def process_batch(frames, model, mode, prepared, quality=None):
+    # Only for batches whose per-image stage is cheap; face attributes are scheduled per image instead
+    quality = quality or QUALITY_LEVELS[0]
+    return [build_detections(frame, boxes, mode, quality)
+            for frame, boxes in zip(frames, predict_batch_boxes(frames, model, prepared))]
+
+def build_detections(frame, boxes, mode, quality):
     class_names = object_class_names if mode == "object" else ["Face"]
     colors = object_colors if mode == "object" else {0: face_color}
-    
-    logger.debug(f"Processing frame in {mode} mode")
-    results = model.predict(frame, conf=0.5)
     detections = []
 
-    if mode == "face":
-        insight_faces = insight_app.get(frame)
-        logger.debug(f"InsightFace returned {len(insight_faces)} faces")
+    if mode == "face" and quality["face_attributes"]:
+        with span("insightface"):
+            insight_faces = insight_app.get(frame)
+        logger.debug("InsightFace returned %d faces", len(insight_faces))
 
-    for result in results[0].boxes:
-        x1, y1, x2, y2 = map(int, result.xyxy[0])
+    pending_faces = []  # (detection index, aligned crop, partial label); emotions are classified in one batch
+
+    for x1, y1, x2, y2, conf, cls_id in boxes:
         if x2 <= x1 or y2 <= y1:
             continue
-        conf = float(result.conf[0])
-        cls_id = int(result.cls[0])
 
         if mode == "object":
             label = class_names[cls_id]
             color = colors.get(cls_id, (255, 255, 255))
+        elif not quality["face_attributes"]:
+            label = "Face"
+            color = face_color
         else:
             yolo_box = (x1, y1, x2, y2)
-            matched_face, best_iou = get_best_matched_insight_face(insight_faces, yolo_box, iou_threshold=0.25)
-            face_aligned = align_and_extract(frame, matched_face, yolo_box, expand_scale=1.25)
+            with span("insightface_match"):
+                matched_face, best_iou = get_best_matched_insight_face(insight_faces, yolo_box, iou_threshold=0.25)
+            with span("align"):
+                face_aligned = align_and_extract(frame, matched_face, yolo_box, expand_scale=1.25)
             if face_aligned is None or face_aligned.size == 0:
-                logger.debug(f"Skipping face: empty crop")
+                logger.debug("Skipping face: empty crop")
                 continue
 
-            age = predict_age(face_aligned)
+            with span("age"):
+                age = predict_age(face_aligned, tta=quality["age_tta"])
             gender, gender_conf = predict_gender_from_matched_face(matched_face, best_iou)
-            emotion, emo_conf = predict_emotion(face_aligned)
+            pending_faces.append((len(detections), face_aligned, f"{gender}, {age}"))
 
-            label = f"{gender}, {age}, {emotion}"
+            label = None
             color = face_color
 
         detections.append({
             "x1": x1, "y1": y1, "x2": x2, "y2": y2,
             "conf": conf, "label": label, "color": color
         })
-    logger.debug(f"Detections: {detections}")
+    if pending_faces:
+        crops = [crop for _, crop, _ in pending_faces]
+        with span("emotion"):
+            emotions = predict_emotions(crops) if quality["emotion"] else [("Unknown", 0.0)] * len(crops)
+        for (idx, _, partial_label), (emotion, _) in zip(pending_faces, emotions):
+            detections[idx]["label"] = f"{partial_label}, {emotion}"
+    logger.debug("Detections: %s", detections)  # formatted only when debug logging is on
     return detections
 
+def har_frame_tensor(frame):
+    frame_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+    pil_frame = transforms.ToPILImage()(frame_rgb)
+    return video_transform(pil_frame)
+
+def predict_activity(clip):
+    video_tensor = torch.stack(clip[:HAR_CLIP_LEN], dim=1).unsqueeze(0)  # (1, C, T, H, W)
+    with torch.no_grad():
+        outputs = har_model(video_tensor)
+        return torch.argmax(outputs, dim=1).item()
+
+def parse_analyses(analyses):
+    requested = [a.strip() for a in analyses.split(",") if a.strip()]
+    invalid = [a for a in requested if a not in FUSED_ANALYSES]
+    if not requested or invalid:
+        raise HTTPException(status_code=400, detail=f"Invalid analyses. Choose from {', '.join(FUSED_ANALYSES)}.")
+    return [a for a in FUSED_ANALYSES if a in requested]
+
+def scale_detections(detections, factor):
+    if factor == 1.0:
+        return detections
+    for d in detections:
+        for k in ("x1", "y1", "x2", "y2"):
+            d[k] = int(round(d[k] * factor))
+    return detections
+
+def save_upload(path, contents):
+    # Hashing and writing a large upload would stall the event loop
+    with open(path, "wb") as f:
+        f.write(contents)
+    return hashlib.sha256(contents).hexdigest()
+
+def open_video_frames(video_path, stride=1, max_frames=None, max_side=None, keyframes_only=False,
+                      use_cache=True, content_hash=None):
+    # Frames come back scaled to max_side; callers map detections back with 1 / frames.scale
+    if use_cache and frame_cache is not None:
+        return frame_cache.open(video_path, stride=stride, max_side=max_side, max_frames=max_frames,
+                                keyframes_only=keyframes_only, content_hash=content_hash)
+    return DecodedFrames(video_path, stride=stride, max_side=max_side, max_frames=max_frames,
+                         keyframes_only=keyframes_only)
+
+def run_fused_analysis(video_path, analyses, quality, client_id, use_cache=True, content_hash=None, keyframes_only=False,
+                       render_path=None):
+    # One decode pass feeds every analysis; object and face share the letterboxed tensor
+    detectors = [(a, object_model if a == "object" else face_model) for a in analyses if a in ("object", "face")]
+    timings = {stage: 0.0 for stage in ["decode", "letterbox"] + list(analyses)}
+    timeline = []
+    clip = []
+    har_done = "har" not in analyses
+
+    # Each source is paired with how often its frames get detectors (None: HAR only)
+    max_side = DECODE_MAX_SIDE["fused"]
+    writer = None
+    if render_path:
+        # Rendering needs every frame, so it always takes the single-pass decode
+        frames = open_video_frames(video_path, max_side=RENDER_MAX_SIDE, use_cache=False)
+        sources = [(frames, VIDEO_SAMPLE_STRIDE)]
+    else:
+        # Detectors only see sampled frames, so the HAR clip gets its own short consecutive source
+        sources = []
+        if not har_done:
+            head = open_video_frames(video_path, max_frames=HAR_CLIP_LEN, max_side=max_side,
+                                     use_cache=use_cache, content_hash=content_hash)
+            sources.append((head, None if keyframes_only else VIDEO_SAMPLE_STRIDE))
+        if detectors:
+            sampled = open_video_frames(video_path, stride=VIDEO_SAMPLE_STRIDE, max_side=max_side,
+                                        keyframes_only=keyframes_only, use_cache=use_cache, content_hash=content_hash)
+            sources.append((sampled, 1))
+
+    last_frame = -1
+    drawn = {}  # latest detections per analysis, in frame coordinates, carried forward between sampled frames
+    caption = None
+    try:
+        for frames, detect_every in sources:
+            for frame_num, frame in frames:
+                if frame_num <= last_frame:
+                    continue  # already analysed by the HAR head source
+                if detect_every:
+                    last_frame = frame_num
+
+                entry = {"frame": frame_num}
+                if not har_done:
+                    t0 = time.perf_counter()
+                    clip.append(har_frame_tensor(frame))
+                    if len(clip) == HAR_CLIP_LEN:
+                        entry["har"] = {"predicted_class_id": run_scheduled(client_id, "bulk", "har", predict_activity, clip), "window": [frame_num - HAR_CLIP_LEN + 1, frame_num]}
+                        caption = f"Activity class {entry['har']['predicted_class_id']}"
+                        har_done = True
+                        clip = []
+                    timings["har"] += time.perf_counter() - t0
+
+                if detectors and detect_every and frame_num % detect_every == 0:
+                    t0 = time.perf_counter()
+                    with span("letterbox"):
+                        prepared = letterbox_tensor(frame, imgsz=quality["imgsz"])
+                    timings["letterbox"] += time.perf_counter() - t0
+                    for name, model in detectors:
+                        t0 = time.perf_counter()
+                        detections = run_scheduled(client_id, "bulk", name, process_frame, frame, model, name,
+                                                   prepared=prepared, quality=quality)
+                        drawn[name] = [dict(d) for d in detections]
+                        entry[name] = scale_detections(detections, 1.0 / frames.scale)
+                        timings[name] += time.perf_counter() - t0
+
+                if len(entry) > 1:
+                    timeline.append(entry)
+                if render_path:
+                    if writer is None:
+                        writer = VideoRenderWriter(render_path, frames.fps)
+                    writer.write(frame, [d for dets in drawn.values() for d in dets], caption)
+            timings["decode"] += frames.decode_seconds
+        if not har_done:
+            raise HTTPException(status_code=400, detail=f"Video too short for HAR (needs at least {HAR_CLIP_LEN} frames).")
+    except BaseException:
+        if writer is not None:
+            writer.abort()
+        raise
+    if writer is not None:
+        t0 = time.perf_counter()
+        writer.close()
+        timings["render_flush"] = time.perf_counter() - t0
+
+    timings = {stage: round(seconds, 4) for stage, seconds in timings.items()}
+    cache_stats = [frames.stats() for frames, _ in sources]
+    return timeline, timings, max(frames.source_frames for frames, _ in sources), cache_stats
+
+def analyze_video(video_path, mode, requested, quality, client_id, use_cache, content_hash, keyframes_only=False,
+                  render_path=None):
+    if mode == "fused":
+        timeline, timings, frame_num, cache_stats = run_fused_analysis(video_path, requested, quality, client_id,
+                                                                       use_cache, content_hash, keyframes_only,
+                                                                       render_path)
+        logger.debug(f"Fused {requested} over {frame_num} frames, timings: {timings}")
+        return {"results": timeline, "analyses": requested, "timings": timings, "frames": frame_num,
+                "frame_cache": cache_stats}
+
+    all_detections = []
+
+    if mode in ["object", "face"] and render_path:
+        # Every frame goes to the writer stage; detections from sampled frames are carried forward
+        model = object_model if mode == "object" else face_model
+        frames = open_video_frames(video_path, max_side=RENDER_MAX_SIDE, use_cache=False)
+        writer = None
+        drawn = []
+        try:
+            for frame_num, frame in frames:
+                if frame_num % VIDEO_SAMPLE_STRIDE == 0:
+                    detections = run_scheduled(client_id, "bulk", mode, process_frame, frame, model, mode, quality=quality)
+                    drawn = [dict(d) for d in detections]
+                    all_detections.append({"frame": frame_num, "detections": scale_detections(detections, 1.0 / frames.scale)})
+                if writer is None:
+                    writer = VideoRenderWriter(render_path, frames.fps)
+                writer.write(frame, drawn)
+        except BaseException:
+            if writer is not None:
+                writer.abort()
+            raise
+        if writer is not None:
+            writer.close()
+
+    elif mode in ["object", "face"]:
+        model = object_model if mode == "object" else face_model
+        frames = open_video_frames(video_path, stride=VIDEO_SAMPLE_STRIDE,  # Process every 5th frame
+                                   max_side=DECODE_MAX_SIDE[mode], keyframes_only=keyframes_only,
+                                   use_cache=use_cache, content_hash=content_hash)
+        for frame_num, frame in frames:
+            detections = run_scheduled(client_id, "bulk", mode, process_frame, frame, model, mode, quality=quality)
+            all_detections.append({"frame": frame_num, "detections": scale_detections(detections, 1.0 / frames.scale)})
+
+    elif mode == "har":
+        frames = open_video_frames(video_path, max_frames=HAR_CLIP_LEN, max_side=DECODE_MAX_SIDE[mode],
+                                   use_cache=use_cache, content_hash=content_hash)
+        clip = [har_frame_tensor(frame) for _, frame in frames]
+
+        if len(clip) < HAR_CLIP_LEN:
+            raise HTTPException(status_code=400, detail="Video too short for HAR (needs at least 16 frames).")
+
+        pred_class = run_scheduled(client_id, "bulk", "har", predict_activity, clip)
+
+        all_detections.append({"predicted_class_id": pred_class})
+
+        logger.info(f"Human activity recognition done. Predicted class ID: {pred_class}")
+
+    cache_stats = frames.stats()
+    logger.debug(f"Processed {frames.source_frames} frames, returning {len(all_detections)} results, frame cache: {cache_stats}")
+    return {"results": all_detections, "frame_cache": cache_stats}
+
+# ================== Batch Image Detection ==================
+def batch_too_large():
+    return HTTPException(status_code=413, detail=f"Batches are limited to {DETECT_BATCH_MAX_FILES} images "
+                                                 f"and {DETECT_BATCH_MAX_BYTES} bytes")
+
+def read_capped(f, limit):
+    # Counts the bytes actually read: zip headers can understate an entry's decompressed size
+    chunks = []
+    size = 0
+    while True:
+        chunk = f.read(UPLOAD_CHUNK_BYTES)
+        if not chunk:
+            return b"".join(chunks)
+        size += len(chunk)
+        if size > limit:
+            raise batch_too_large()
+        chunks.append(chunk)
+
+async def read_upload(upload, limit):
+    chunks = []
+    size = 0
+    while True:
+        chunk = await upload.read(UPLOAD_CHUNK_BYTES)
+        if not chunk:
+            return b"".join(chunks)
+        size += len(chunk)
+        if size > limit:
+            raise batch_too_large()
+        chunks.append(chunk)
+
+def read_zip_images(contents, archive_name, max_files, max_bytes):
+    images = []
+    total = 0
+    with zipfile.ZipFile(io.BytesIO(contents)) as archive:
+        for info in archive.infolist():
+            if info.is_dir() or not info.filename.lower().endswith(IMAGE_EXTS):
+                continue
+            if len(images) >= max_files:
+                raise batch_too_large()
+            with archive.open(info) as member:
+                data = read_capped(member, max_bytes - total)
+            total += len(data)
+            images.append((f"{archive_name}/{info.filename}", data))
+    return images
+
+def prepare_image(contents, imgsz):
+    frame = decode_image(contents)
+    if frame is None:
+        return None, None
+    with span("letterbox"):
+        return frame, letterbox_tensor(frame, imgsz=imgsz)
+
+async def stream_batch_detections(images, mode, client_id):
+    """Yields one NDJSON line per image, in completion order, then a summary line."""
+    model = object_model if mode == "object" else face_model
+    level, quality = load_governor.quality()
+    slots = asyncio.Semaphore(DETECT_BATCH_PREFETCH)
+    groups = {}  # letterboxed tensor shape -> [(index, name, frame, prepared)]
+    grouped = 0
+    remaining = len(images)
+    failed = 0
+    start = time.perf_counter()
+
+    async def prepare(index, name, contents):
+        await slots.acquire()
+        try:
+            future = decode_pool.submit(contextvars.copy_context().run, prepare_image, contents, quality["imgsz"])
+            frame, prepared = await asyncio.wrap_future(future)
+        except Exception as e:
+            logger.debug("Failed to decode %s: %s", name, e)
+            frame = prepared = None
+        return "decoded", (index, name, frame, prepared)
+
+    async def detect(batch):
+        frames = [item[2] for item in batch]
+        prepared = [item[3] for item in batch]
+        try:
+            if mode == "face" and quality["face_attributes"]:
+                # InsightFace, age and emotion go in one scheduled call per image, so another client's
+                # request waits for at most one image's attributes rather than the whole batch
+                boxes = await run_inference(client_id, "bulk", "face_batch", predict_batch_boxes, frames, model, prepared)
+                results = []
+                for frame, frame_boxes in zip(frames, boxes):
+                    results.append(await run_inference(client_id, "bulk", "face_attributes", build_detections,
+                                                       frame, frame_boxes, mode, quality))
+            else:
+                results = await run_inference(client_id, "bulk", f"{mode}_batch", process_batch,
+                                              frames, model, mode, prepared, quality=quality)
+            lines = [{"index": index, "filename": name, "detections": detections}
+                     for (index, name, _, _), detections in zip(batch, results)]
+        except Exception as e:
+            logger.error(f"Error in batch detection: {str(e)}")
+            lines = [{"index": index, "filename": name, "error": str(e)} for index, name, _, _ in batch]
+        finally:
+            for _ in batch:
+                slots.release()
+        return "detected", lines
+
+    pending = {asyncio.ensure_future(prepare(i, name, contents)) for i, (name, contents) in enumerate(images)}
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                kind, payload = task.result()
+                if kind == "detected":
+                    with span("serialize"):
+                        for line in payload:
+                            failed += "error" in line
+                            line["quality_level"] = level
+                            yield json.dumps(line) + "\n"
+                    continue
+
+                remaining -= 1
+                index, name, frame, prepared = payload
+                if frame is None:
+                    slots.release()
+                    failed += 1
+                    yield json.dumps({"index": index, "filename": name, "error": "Invalid image",
+                                      "quality_level": level}) + "\n"
+                else:
+                    group = groups.setdefault(tuple(prepared[0].shape), [])
+                    group.append(payload)
+                    grouped += 1
+                    if len(group) == DETECT_BATCH_SIZE:
+                        del groups[tuple(prepared[0].shape)]
+                        grouped -= len(group)
+                        pending.add(asyncio.ensure_future(detect(group)))
+                # Partial groups go out largest first when half the prefetch slots sit in them (so a
+                # mix of sizes cannot stall decoding), and all of them once decoding is over
+                while groups and (grouped >= DETECT_BATCH_PREFETCH // 2 or remaining == 0):
+                    batch = groups.pop(max(groups, key=lambda shape: len(groups[shape])))
+                    grouped -= len(batch)
+                    pending.add(asyncio.ensure_future(detect(batch)))
+    finally:
+        for task in pending:
+            task.cancel()  # client went away
+    yield json.dumps({"done": True, "count": len(images), "failed": failed,
+                      "seconds": round(time.perf_counter() - start, 4)}) + "\n"
+
 # ================== Endpoints ==================
 
 @app.post("/detect_objects/")
-async def detect_objects(file: UploadFile = File(...)):
-    logger.debug(f"Received object detection request: {file.filename}")
+async def detect_objects(request: Request, file: UploadFile = File(...)):
+    logger.debug("Received object detection request: %s", file.filename)
     try:
         contents = await file.read()
-        nparr = np.frombuffer(contents, np.uint8)
-        frame = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+        frame = decode_image(contents)
         if frame is None:
             logger.error("Failed to decode image")
             raise HTTPException(status_code=400, detail="Invalid image")
-        detections = process_frame(frame, object_model, "object")
-        return {"detections": detections}
+        level, quality = load_governor.quality()
+        detections = await run_inference(client_key(request), "interactive", "object",
+                                         process_frame, frame, object_model, "object", quality=quality)
+        return json_response({"detections": detections, "quality_level": level})
     except Exception as e:
         logger.error(f"Error in detect_objects: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/detect_faces/")
-async def detect_faces(file: UploadFile = File(...)):
-    logger.debug(f"Received face detection request: {file.filename}")
+async def detect_faces(request: Request, file: UploadFile = File(...)):
+    logger.debug("Received face detection request: %s", file.filename)
     try:
         contents = await file.read()
-        nparr = np.frombuffer(contents, np.uint8)
-        frame = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+        frame = decode_image(contents)
         if frame is None:
             logger.error("Failed to decode image")
             raise HTTPException(status_code=400, detail="Invalid image")
-        detections = process_frame(frame, face_model, "face")
-        return {"detections": detections}
+        level, quality = load_governor.quality()
+        detections = await run_inference(client_key(request), "interactive", "face",
+                                         process_frame, frame, face_model, "face", quality=quality)
+        return json_response({"detections": detections, "quality_level": level})
     except Exception as e:
         logger.error(f"Error in detect_faces: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/detect_batch/{mode}")
+async def detect_batch(request: Request, mode: str):
+    # Many images per request (multipart "files" fields and/or zip archives); results stream back as NDJSON.
+    # The form is parsed here rather than through File(...) so the limits apply before the body is spooled.
+    if mode not in ["object", "face"]:
+        raise HTTPException(status_code=400, detail="Invalid mode. Use 'object' or 'face'.")
+    if "content-length" not in request.headers:
+        raise HTTPException(status_code=411, detail="Content-Length required")
+    try:
+        length = int(request.headers["content-length"])
+    except ValueError:
+        length = -1
+    if length < 0:
+        raise HTTPException(status_code=400, detail="Invalid Content-Length")
+    if length > DETECT_BATCH_MAX_BYTES:
+        raise batch_too_large()
+    images = []
+    held = 0
+    async with request.form(max_files=DETECT_BATCH_MAX_FILES) as form:
+        for upload in form.getlist("files"):
+            if isinstance(upload, str):
+                continue
+            contents = await read_upload(upload, DETECT_BATCH_MAX_BYTES - held)
+            name = upload.filename or f"file-{len(images)}"
+            if name.lower().endswith(".zip") or upload.content_type in ZIP_CONTENT_TYPES:
+                try:
+                    members = await run_in_threadpool(read_zip_images, contents, name,
+                                                      DETECT_BATCH_MAX_FILES - len(images), DETECT_BATCH_MAX_BYTES - held)
+                except zipfile.BadZipFile:
+                    raise HTTPException(status_code=400, detail=f"Invalid zip archive: {name}")
+                images.extend(members)
+                held += sum(len(data) for _, data in members)
+            else:
+                if len(images) >= DETECT_BATCH_MAX_FILES:
+                    raise batch_too_large()
+                images.append((name, contents))
+                held += len(contents)
+    if not images:
+        raise HTTPException(status_code=400, detail="No images in request")
+    logger.debug("Received batch %s detection request with %d images", mode, len(images))
+    return StreamingResponse(stream_batch_detections(images, mode, client_key(request)),
+                             media_type="application/x-ndjson")
+
 @app.post("/process_video/{mode}")
-async def process_video(mode: str, file: UploadFile = File(...)):
-    if mode not in ["object", "face", "har"]:
+async def process_video(request: Request, mode: str, file: UploadFile = File(...), analyses: str = ",".join(FUSED_ANALYSES),
+                        use_cache: bool = True, keyframes_only: bool = False, render: bool = False):
+    if mode not in ["object", "face", "har", "fused"]:
         logger.error(f"Invalid mode: {mode}")
-        raise HTTPException(status_code=400, detail="Invalid mode. Use 'object', 'face', or 'har'.")
+        raise HTTPException(status_code=400, detail="Invalid mode. Use 'object', 'face', 'har', or 'fused'.")
+    if render and mode == "har":
+        raise HTTPException(status_code=400, detail="Rendering is available for 'object', 'face' and 'fused' modes.")
+    video_id = uuid.uuid4().hex if render else None
+    render_path = os.path.join(RENDER_DIR, f"{video_id}.mp4") if render else None
+    requested = parse_analyses(analyses) if mode == "fused" else None
     
-    temp_path = "temp_video.mp4"
+    # Analysis runs in the threadpool, so uploads overlap and each needs its own temp file
+    temp_path = f"temp_video_{uuid.uuid4().hex}.mp4"
     logger.debug(f"Saving video to {temp_path}")
     try:
-        with open(temp_path, "wb") as f:
-            f.write(await file.read())
-        
-        cap = cv2.VideoCapture(temp_path)
-        all_detections = []
-        frame_num = 0
-        
-        if mode in ["object", "face"]:
-            model = object_model if mode == "object" else face_model
-
-            while cap.isOpened():
-                ret, frame = cap.read()
-                if not ret:
-                    break
-                if frame_num % 5 == 0:  # Process every 5th frame
-                    detections = process_frame(frame, model, mode)
-                    all_detections.append({"frame": frame_num, "detections": detections})
-                frame_num += 1
-
-        elif mode == "har":
-            frames = []
-            while cap.isOpened():
-                ret, frame = cap.read()
-                if not ret:
-                    break
-                frame_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-                pil_frame = transforms.ToPILImage()(frame_rgb)
-                tensor_frame = video_transform(pil_frame)
-                frames.append(tensor_frame)
-            cap.release()
-
-            if len(frames) < 16:
-                raise HTTPException(status_code=400, detail="Video too short for HAR (needs at least 16 frames).")
-
-            video_tensor = torch.stack(frames[:16], dim=1).unsqueeze(0)  # (1, C, T, H, W)
-            with torch.no_grad():
-                outputs = har_model(video_tensor)
-                pred_class = torch.argmax(outputs, dim=1).item()
-            
-            all_detections.append({"predicted_class_id": pred_class})
-
-            logger.info(f"Human activity recognition done. Predicted class ID: {pred_class}")
-
-
-        cap.release()
-        os.remove(temp_path)
-        logger.debug(f"Processed {frame_num} frames, returning {len(all_detections)} results")
-        return {"results": all_detections}
+        contents = await file.read()
+        content_hash = await run_in_threadpool(save_upload, temp_path, contents)
+
+        level, quality = load_governor.quality()
+        response = await run_in_threadpool(analyze_video, temp_path, mode, requested, quality, client_key(request),
+                                           use_cache, content_hash, keyframes_only, render_path)
+        response["quality_level"] = level
+        if render:
+            prune_rendered()
+            response["rendered_video"] = f"/rendered/{video_id}"
+        return json_response(response)
+    except HTTPException:
+        raise  # e.g. a video too short for HAR stays a 400
     except Exception as e:
         logger.error(f"Error in process_video: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+    finally:
         if os.path.exists(temp_path):
             os.remove(temp_path)
-        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/rendered/{video_id}")
+async def rendered_video(video_id: str):
+    path = os.path.join(RENDER_DIR, f"{video_id}.mp4")
+    if not re.fullmatch(r"[0-9a-f]{32}", video_id) or not os.path.exists(path):
+        raise HTTPException(status_code=404, detail="Rendered video not found")
+    return FileResponse(path, media_type="video/mp4", filename=f"{video_id}.mp4")
+
+if PROFILING_ENABLED:
+    @app.middleware("http")
+    async def profile_request(request: Request, call_next):
+        # X-Profile: trace | cprofile | torch, together with X-Admin-Token, traces this one request
+        profiler = request.headers.get("x-profile")
+        if profiler not in PROFILERS or not is_admin(request):
+            return await call_next(request)
+        trace = Trace(f"{request.method} {request.url.path}", profiler)
+        tokens = trace.activate()
+        try:
+            with span("request"):
+                response = await call_next(request)
+        finally:
+            Trace.deactivate(tokens)
+        response.headers["X-Trace-Id"] = trace.id
+
+        async def traced_body(body):
+            # Streaming endpoints (/detect_batch) keep producing spans until the body is sent,
+            # so the trace is only saved once the last chunk has gone out
+            try:
+                async for chunk in body:
+                    yield chunk
+            finally:
+                summary = await run_in_threadpool(trace_store.save, trace)
+                logger.info("Traced %s in %.4fs (trace %s)", trace.name, summary["seconds"], trace.id)
+        response.body_iterator = traced_body(response.body_iterator)
+        return response
+
+@app.get("/admin/profile/stacks")
+async def profile_stacks(request: Request, seconds: float = 10.0, interval_ms: float = 5.0):
+    # Samples every thread's Python stack; the result feeds flamegraph.pl / speedscope directly
+    require_admin(request)
+    if not seconds > 0:
+        raise HTTPException(status_code=400, detail="seconds must be positive")
+    stacks = await run_in_threadpool(sample_stacks, seconds, interval_ms / 1000.0)
+    if stacks is None:
+        raise HTTPException(status_code=409, detail="A stack sampling run is already in progress")
+    path = write_folded(os.path.join(PROFILE_DIR, f"stacks-{int(time.time())}.folded"), stacks)
+    return FileResponse(path, media_type="text/plain", filename=os.path.basename(path))
+
+@app.get("/admin/profile/traces")
+async def profile_traces(request: Request):
+    require_admin(request)
+    return {"traces": trace_store.list()}
+
+@app.get("/admin/profile/traces/{trace_id}")
+async def profile_trace(request: Request, trace_id: str, format: str = "chrome"):
+    require_admin(request)
+    summary = trace_store.get(trace_id)
+    if summary is None:
+        raise HTTPException(status_code=404, detail="Trace not found")
+    if format not in summary["formats"]:
+        raise HTTPException(status_code=400, detail=f"Trace {trace_id} has formats: {', '.join(summary['formats'])}")
+    path = trace_store.path(trace_id, format)
+    media_type = "application/json" if format == "chrome" else "application/octet-stream" if format == "cprofile" else "text/plain"
+    return FileResponse(path, media_type=media_type, filename=os.path.basename(path))
+
+@app.get("/load_status/")
+async def load_status():
+    return load_governor.stats()
+
+@app.get("/scheduler_stats/")
+async def scheduler_stats():
+    return scheduler.stats()
 
 @app.websocket("/ws_detect/{mode}")
 async def websocket_endpoint(websocket: WebSocket, mode: str):
     await websocket.accept()
     model = object_model if mode == "object" else face_model
-    logger.debug(f"WebSocket connected for {mode} detection")
+    client_id = client_key(websocket)
+    logger.debug(f"WebSocket connected for {mode} detection ({client_id})")
     
     try:
         while True:
@@ -424,11 +977,12 @@ async def websocket_endpoint(websocket: WebSocket, mode: str):
             if data == "close":
                 break
             img_bytes = base64.b64decode(data)
-            frame = cv2.imdecode(np.frombuffer(img_bytes, dtype=np.uint8), cv2.IMREAD_COLOR)
-            detections = process_frame(frame, model, mode)
-            await websocket.send_json({"detections": detections})
+            frame = decode_image(img_bytes)
+            level, quality = load_governor.quality()
+            detections = await run_inference(client_id, "interactive", mode, process_frame, frame, model, mode, quality=quality)
+            await websocket.send_json({"detections": detections, "quality_level": level})
     except Exception as e:
         logger.error(f"WebSocket error: {str(e)}")
     finally:
         await websocket.close()
-        logger.debug("WebSocket closed")
\ No newline at end of file
+        logger.debug("WebSocket closed")
@@ -0,0 +1,303 @@
+import os
+import json
+import time
+import queue
+import logging
+import argparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import multiprocessing
+from resources import cpu_count
+
+# Offline batch analysis of image folders and video archives with the same
+# process_frame pipeline as the FastAPI app. Each worker process imports app
+# (and so loads every model) exactly once.
+#
+#   python batch_process.py /data/archive --mode face --output results.jsonl --workers 4
+
+logger = logging.getLogger("batch_process")
+
+IMAGE_EXTS = {".jpg", ".jpeg", ".png", ".bmp", ".webp"}
+VIDEO_EXTS = {".mp4", ".avi", ".mov", ".mkv", ".webm"}
+
+_END = object()
+
+# ================== Worker Side ==================
+app = None
+results = None  # records go back to the driver through this queue as each file finishes
+
+def init_worker(threads, result_queue):
+    global app, results
+    results = result_queue
+    from resources import RESOURCES, worker_env, load_budget
+    for key, value in worker_env(threads).items():
+        os.environ.setdefault(key, value)  # split the host's cores between workers; explicit env wins
+    RESOURCES.update(load_budget())  # resources was imported (and the budget read) before the env above
+    import app as app_module  # loads the models once per process
+    logging.getLogger().setLevel(logging.WARNING)
+    app = app_module
+
+def iter_file_frames(path, stride, use_cache):
+    import cv2  # not at module level: spawned workers import this module before init_worker sets the thread env
+    ext = os.path.splitext(path)[1].lower()
+    if ext in IMAGE_EXTS:
+        frame = cv2.imread(path, cv2.IMREAD_COLOR)
+        if frame is None:
+            raise ValueError("Failed to decode image")
+        yield None, frame, 1.0
+        return
+    frames = app.open_video_frames(path, stride=stride, max_side=app.DECODE_MAX_SIDE["fused"], use_cache=use_cache)
+    for frame_num, frame in frames:
+        yield frame_num, frame, frames.scale
+
+def decode_into(path, stride, use_cache, q):
+    try:
+        for item in iter_file_frames(path, stride, use_cache):
+            q.put(item)
+        q.put(_END)
+    except Exception as e:
+        q.put(e)
+
+def drain(q):
+    while True:
+        item = q.get()
+        if item is _END:
+            return
+        if isinstance(item, Exception):
+            raise item
+        yield item
+
+def iter_prefetched(paths, stride, use_cache, threads, depth):
+    # Decode up to `threads` files ahead of inference, each through a bounded frame queue
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        pending = deque()
+        remaining = iter(paths)
+
+        def submit_next():
+            path = next(remaining, None)
+            if path is not None:
+                q = queue.Queue(maxsize=depth)
+                pool.submit(decode_into, path, stride, use_cache, q)
+                pending.append((path, q))
+
+        for _ in range(threads):
+            submit_next()
+        while pending:
+            path, q = pending.popleft()
+            frames = drain(q)
+            try:
+                yield path, frames
+            finally:
+                try:
+                    for _ in frames:  # unblock the decoder if the consumer stopped early
+                        pass
+                except Exception as e:
+                    logger.warning(f"Ignoring decode error while skipping the rest of {path}: {e}")
+            submit_next()
+
+def process_shard(shard_id, paths, mode, stride, use_cache, prefetch_threads, prefetch_depth):
+    model = app.object_model if mode == "object" else app.face_model
+    for path, frames in iter_prefetched(paths, stride, use_cache, prefetch_threads, prefetch_depth):
+        start = time.perf_counter()
+        record = {"path": path, "mode": mode, "results": [], "error": None}
+        try:
+            for frame_num, frame, scale in frames:
+                detections = app.scale_detections(app.process_frame(frame, model, mode), 1.0 / scale)
+                if frame_num is None:
+                    record["results"] = detections
+                else:
+                    record["results"].append({"frame": frame_num, "detections": detections})
+        except Exception as e:
+            record["error"] = str(e)
+        record["type"] = "video" if os.path.splitext(path)[1].lower() in VIDEO_EXTS else "image"
+        record["seconds"] = round(time.perf_counter() - start, 4)
+        results.put((shard_id, record))
+    results.put((shard_id, None))  # sent after every record, so the driver knows the shard is finished
+
+# ================== Output ==================
+# write() and close() return the records that are now on disk, which the driver then checkpoints
+class JsonlWriter:
+    def __init__(self, path):
+        self.f = open(path, "a")
+
+    def write(self, records):
+        for record in records:
+            self.f.write(json.dumps(record) + "\n")
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        return records
+
+    def close(self):
+        self.f.close()
+        return []
+
+    @staticmethod
+    def written_paths(path):
+        # Records that reached the output even if the checkpoint write after them did not
+        if not os.path.exists(path):
+            return set()
+        paths = set()
+        with open(path) as f:
+            for line in f:
+                try:
+                    paths.add(json.loads(line)["path"])
+                except (ValueError, KeyError, TypeError):
+                    continue  # a line cut short by a crash
+        return paths
+
+class ParquetWriter:
+    # Whole part files only, so an interrupted run never leaves a truncated file behind; records are
+    # buffered into parts of ROWS_PER_PART, and close() (also reached on Ctrl-C) writes the rest
+    ROWS_PER_PART = 64
+
+    def __init__(self, path):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        self.pa, self.pq = pa, pq
+        self.dir = path
+        self.prefix = f"part-{int(time.time())}"
+        self.parts = 0
+        self.buffer = []
+        os.makedirs(path, exist_ok=True)
+
+    def write(self, records):
+        self.buffer.extend(records)
+        if len(self.buffer) < self.ROWS_PER_PART:
+            return []
+        return self.flush()
+
+    def flush(self):
+        records, self.buffer = self.buffer, []
+        if not records:
+            return []
+        table = self.pa.Table.from_pylist([
+            {"path": r["path"], "type": r["type"], "mode": r["mode"], "seconds": r["seconds"],
+             "error": r["error"], "results": json.dumps(r["results"])}
+            for r in records
+        ])
+        self.pq.write_table(table, os.path.join(self.dir, f"{self.prefix}-{self.parts:05d}.parquet"))
+        self.parts += 1
+        return records
+
+    def close(self):
+        return self.flush()
+
+    @staticmethod
+    def written_paths(path):
+        if not os.path.isdir(path):
+            return set()
+        import pyarrow.parquet as pq
+        paths = set()
+        for name in os.listdir(path):
+            if name.endswith(".parquet"):
+                paths.update(pq.read_table(os.path.join(path, name), columns=["path"]).column("path").to_pylist())
+        return paths
+
+# ================== Driver ==================
+def collect_files(inputs):
+    files = []
+    for root in inputs:
+        if os.path.isfile(root):
+            files.append(os.path.abspath(root))
+            continue
+        for dirpath, _, filenames in os.walk(root):
+            for name in filenames:
+                if os.path.splitext(name)[1].lower() in IMAGE_EXTS | VIDEO_EXTS:
+                    files.append(os.path.abspath(os.path.join(dirpath, name)))
+    return sorted(files)
+
+def load_checkpoint(path):
+    if not os.path.exists(path):
+        return set()
+    with open(path) as f:
+        return {line.rstrip("\n") for line in f if line.strip()}
+
+def run(args):
+    files = collect_files(args.inputs)
+    checkpoint_path = args.checkpoint or f"{args.output}.done"
+    writer_cls = ParquetWriter if args.output.endswith(".parquet") else JsonlWriter
+    done = load_checkpoint(checkpoint_path) | writer_cls.written_paths(args.output)
+    pending = [f for f in files if f not in done]
+    logger.info(f"{len(files)} files found, {len(files) - len(pending)} already done, {len(pending)} to process")
+    if not pending:
+        return
+
+    writer = writer_cls(args.output)
+    checkpoint = open(checkpoint_path, "a")
+    shards = [pending[i:i + args.shard_size] for i in range(0, len(pending), args.shard_size)]
+    processed = 0
+    failed = 0
+    start = time.perf_counter()
+
+    def save(records):
+        # Called with records already in the output: every written record, failed or not, is done for good
+        nonlocal processed, failed
+        if not records:
+            return
+        checkpoint.write("".join(r["path"] + "\n" for r in records))
+        checkpoint.flush()
+        processed += len(records)
+        failed += sum(1 for r in records if r["error"] is not None)
+        logger.info(f"{processed}/{len(pending)} files")
+
+    ctx = multiprocessing.get_context("spawn")
+    result_queue = ctx.Queue()
+    threads = max(1, cpu_count() // args.workers)
+    pool = ProcessPoolExecutor(max_workers=args.workers, mp_context=ctx, initializer=init_worker,
+                               initargs=(threads, result_queue))
+    try:
+        futures = {
+            pool.submit(process_shard, shard_id, shard, args.mode, args.stride, args.use_cache,
+                        args.prefetch_threads, args.prefetch_depth): shard_id
+            for shard_id, shard in enumerate(shards)
+        }
+        running = set(futures.values())
+        while running:
+            try:
+                shard_id, record = result_queue.get(timeout=1.0)
+            except queue.Empty:
+                for future, shard_id in futures.items():
+                    if shard_id in running and future.done() and future.exception() is not None:
+                        # Files the shard finished are written; the rest are retried by the next run
+                        logger.error(f"Shard of {len(shards[shard_id])} files failed: {future.exception()}")
+                        running.discard(shard_id)
+                continue
+            if record is None:
+                running.discard(shard_id)
+            else:
+                save(writer.write([record]))
+    except BaseException:
+        # Don't wait for the running shards: every file they finished is already written and checkpointed
+        logger.warning("Stopping; finished files are checkpointed, rerun to resume")
+        workers = list((pool._processes or {}).values())
+        pool.shutdown(wait=False, cancel_futures=True)
+        for process in workers:
+            process.terminate()
+        raise
+    else:
+        pool.shutdown()
+    finally:
+        save(writer.close())
+        checkpoint.close()
+
+    elapsed = time.perf_counter() - start
+    logger.info(f"Processed {processed} files ({failed} failed) in {elapsed:.1f}s "
+                f"({processed / max(elapsed, 1e-9):.2f} files/sec)")
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Batch object/face analysis over image folders and video archives.")
+    parser.add_argument("inputs", nargs="+", help="Directories or files to analyse")
+    parser.add_argument("--mode", choices=["object", "face"], default="object")
+    parser.add_argument("--output", default="batch_results.jsonl", help="*.jsonl file or *.parquet directory")
+    parser.add_argument("--checkpoint", help="Completed-file list (default: <output>.done)")
+    parser.add_argument("--workers", type=int, default=max(1, (os.cpu_count() or 2) // 2))
+    parser.add_argument("--shard-size", type=int, default=16, help="Files per worker task (records stream back per file)")
+    parser.add_argument("--stride", type=int, default=5, help="Analyse every Nth video frame")
+    parser.add_argument("--prefetch-threads", type=int, default=2, help="Files decoded ahead per worker")
+    parser.add_argument("--prefetch-depth", type=int, default=8, help="Decoded frames buffered per file")
+    parser.add_argument("--use-cache", action="store_true", help="Read/populate the decoded-frame cache")
+    return parser.parse_args(argv)
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    run(parse_args())
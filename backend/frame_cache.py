@@ -0,0 +1,259 @@
+import os
+import json
+import time
+import uuid
+import shutil
+import hashlib
+import logging
+import numpy as np
+from video_decoder import open_decoder, resolve_backend, DECODE_BACKEND
+from profiling import span
+
+logger = logging.getLogger(__name__)
+
+# ================== Configuration ==================
+FRAME_CACHE_DIR = os.environ.get("FRAME_CACHE_DIR", "frame_cache")
+FRAME_CACHE_MAX_BYTES = int(os.environ.get("FRAME_CACHE_MAX_BYTES", str(2 * 1024 ** 3)))  # 0 disables the cache
+
+META_FILE = "meta.json"
+FRAMES_FILE = "frames.bin"
+TMP_PREFIX = ".tmp-"
+TMP_MAX_AGE = 3600  # seconds before an unfinished entry counts as left behind by a crashed decode
+
+# ================== Helpers ==================
+def hash_file(path, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+# ================== Frame Sources ==================
+class DecodedFrames:
+    """Decodes a video through the configured decoder backend, yielding (frame_num, frame)."""
+
+    hit = False
+
+    def __init__(self, source, stride=1, max_side=None, max_frames=None, keyframes_only=False, backend=DECODE_BACKEND):
+        self.decoder = open_decoder(source, backend, stride=stride, max_side=max_side, keyframes_only=keyframes_only)
+        self.max_frames = max_frames
+        self.count = 0
+        self.decode_seconds = 0.0
+
+    @property
+    def fps(self):
+        return self.decoder.fps
+
+    @property
+    def scale(self):
+        return self.decoder.scale
+
+    @property
+    def source_frames(self):
+        return self.decoder.source_frames
+
+    def __iter__(self):
+        frame_iter = iter(self.decoder)
+        try:
+            while self.max_frames is None or self.count < self.max_frames:
+                t0 = time.perf_counter()
+                try:
+                    with span("decode"):
+                        frame_num, frame = next(frame_iter)
+                finally:
+                    self.decode_seconds += time.perf_counter() - t0
+                yield frame_num, frame
+                self.count += 1
+        except StopIteration:
+            return
+        finally:
+            frame_iter.close()
+
+    def stats(self):
+        return {"hit": False, "decode_seconds": round(self.decode_seconds, 4)}
+
+class CachedFrames:
+    """Frames served from a cache entry, or decoded and written to one on a miss."""
+
+    def __init__(self, cache, entry_dir, source, stride, max_side, max_frames, keyframes_only, backend=DECODE_BACKEND):
+        self.cache = cache
+        self.entry_dir = entry_dir
+        self.stride = stride
+        self.max_side = max_side
+        self.max_frames = max_frames
+        self.keyframes_only = keyframes_only
+        self.meta = cache.load_meta(entry_dir)
+        self.hit = self.meta is not None
+        self.decoder = None if self.hit else DecodedFrames(source, stride, max_side, max_frames, keyframes_only, backend)
+        self.read_seconds = 0.0
+
+    def __getattr__(self, name):
+        if name in ("fps", "scale", "source_frames", "count"):
+            if self.meta is not None:
+                return self.meta[name]
+            return getattr(self.decoder, name)
+        raise AttributeError(name)
+
+    @property
+    def decode_seconds(self):
+        return self.read_seconds if self.hit else self.decoder.decode_seconds
+
+    def __iter__(self):
+        if self.hit:
+            return self._read()
+        return self._decode_and_store()
+
+    def _read(self):
+        t0 = time.perf_counter()
+        frames = self.cache.open_frames(self.entry_dir, self.meta)
+        self.read_seconds += time.perf_counter() - t0
+        frame_numbers = self.meta.get("frame_numbers")
+        for i in range(len(frames)):
+            frame_num = frame_numbers[i] if frame_numbers else i * self.stride
+            yield frame_num, frames[i]  # zero-copy view into the memory map
+
+    def _decode_and_store(self):
+        tmp_dir = os.path.join(self.cache.root, f"{TMP_PREFIX}{uuid.uuid4().hex}")
+        os.makedirs(tmp_dir)
+        shape = None
+        frame_numbers = []
+        written = 0
+        complete = False
+        out = open(os.path.join(tmp_dir, FRAMES_FILE), "wb")
+        try:
+            for frame_num, frame in self.decoder:
+                if out is not None:
+                    written += frame.nbytes
+                    if written > self.cache.max_bytes:
+                        # Stop writing as soon as the entry outgrows the budget; the caller still gets every frame
+                        logger.debug(f"Frame cache entry passed {self.cache.max_bytes} bytes, not caching")
+                        out.close()
+                        out = None
+                        shutil.rmtree(tmp_dir, ignore_errors=True)
+                    else:
+                        if shape is None:
+                            shape = frame.shape
+                        frame_numbers.append(frame_num)
+                        out.write(np.ascontiguousarray(frame, dtype=np.uint8).tobytes())
+                yield frame_num, frame
+            complete = out is not None
+        finally:
+            if out is not None:
+                out.close()
+            if complete and shape is not None:
+                meta = {
+                    "fps": self.decoder.fps,
+                    "stride": self.stride,
+                    "max_side": self.max_side,
+                    "max_frames": self.max_frames,
+                    "scale": self.decoder.scale,
+                    "source_frames": self.decoder.source_frames,
+                    "count": self.decoder.count,
+                    "shape": list(shape),
+                    "decode_seconds": self.decoder.decode_seconds,
+                }
+                if self.keyframes_only:
+                    meta["frame_numbers"] = frame_numbers  # keyframes are not evenly spaced
+                self.cache.commit(tmp_dir, self.entry_dir, meta)
+            else:
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def stats(self):
+        if self.hit:
+            saved = max(0.0, self.meta["decode_seconds"] - self.read_seconds)
+            return {"hit": True, "read_seconds": round(self.read_seconds, 4), "decode_seconds_saved": round(saved, 4)}
+        return self.decoder.stats()
+
+# ================== Cache ==================
+class FrameCache:
+    """Content-addressed store of downscaled, sampled frames kept as raw uint8 arrays for np.memmap."""
+
+    def __init__(self, root=FRAME_CACHE_DIR, max_bytes=FRAME_CACHE_MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        os.makedirs(root, exist_ok=True)
+        self.sweep_tmp()
+
+    @staticmethod
+    def key(content_hash, stride=1, max_side=None, max_frames=None, keyframes_only=False, backend="opencv"):
+        # Backends differ in scaling filters and keyframe handling, so their frames are not interchangeable
+        key = f"{content_hash}_s{stride}_m{max_side or 0}_n{max_frames or 0}_{backend}"
+        return key + ("_k" if keyframes_only else "")
+
+    def open(self, path, stride=1, max_side=None, max_frames=None, keyframes_only=False, content_hash=None,
+             backend=DECODE_BACKEND):
+        content_hash = content_hash or hash_file(path)
+        backend = resolve_backend(path, backend)
+        key = self.key(content_hash, stride, max_side, max_frames, keyframes_only, backend)
+        return CachedFrames(self, os.path.join(self.root, key), path, stride, max_side, max_frames, keyframes_only,
+                            backend)
+
+    def load_meta(self, entry_dir):
+        meta_path = os.path.join(entry_dir, META_FILE)
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+            os.utime(meta_path)  # LRU timestamp
+            return meta
+        except (OSError, ValueError):
+            return None
+
+    def open_frames(self, entry_dir, meta):
+        shape = (meta["count"], *meta["shape"])
+        return np.memmap(os.path.join(entry_dir, FRAMES_FILE), dtype=np.uint8, mode="r", shape=shape)
+
+    def commit(self, tmp_dir, entry_dir, meta):
+        with open(os.path.join(tmp_dir, META_FILE), "w") as f:
+            json.dump(meta, f)
+        try:
+            os.rename(tmp_dir, entry_dir)
+        except OSError:
+            # Another request stored the same entry first
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            return
+        logger.debug(f"Cached {meta['count']} frames in {entry_dir}")
+        self.evict(keep=entry_dir)
+
+    def entries(self):
+        entries = []
+        for name in os.listdir(self.root):
+            entry_dir = os.path.join(self.root, name)
+            meta_path = os.path.join(entry_dir, META_FILE)
+            if name.startswith(TMP_PREFIX) or not os.path.exists(meta_path):
+                continue
+            try:
+                size = os.path.getsize(os.path.join(entry_dir, FRAMES_FILE))
+                entries.append((os.path.getmtime(meta_path), size, entry_dir))
+            except OSError:
+                continue
+        return entries
+
+    def sweep_tmp(self, max_age=TMP_MAX_AGE):
+        # Unfinished entries of decodes that crashed; live ones are younger than max_age
+        now = time.time()
+        for name in os.listdir(self.root):
+            tmp_dir = os.path.join(self.root, name)
+            if not name.startswith(TMP_PREFIX):
+                continue
+            frames_path = os.path.join(tmp_dir, FRAMES_FILE)
+            try:
+                # frames.bin is appended to while a decode is running, so its mtime tracks progress
+                last_write = os.path.getmtime(frames_path if os.path.exists(frames_path) else tmp_dir)
+                if now - last_write > max_age:
+                    shutil.rmtree(tmp_dir, ignore_errors=True)
+                    logger.debug(f"Removed stale frame cache temp dir {tmp_dir}")
+            except OSError:
+                continue
+
+    def evict(self, keep=None):
+        self.sweep_tmp()
+        entries = sorted(self.entries())  # least recently used first
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry_dir in entries:
+            if total <= self.max_bytes:
+                break
+            if entry_dir == keep:
+                continue
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            total -= size
+            logger.debug(f"Evicted frame cache entry {entry_dir}")
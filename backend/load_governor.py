@@ -0,0 +1,87 @@
+import os
+import json
+import time
+import logging
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# ================== Quality Levels ==================
+# Level 0 is full quality; each following level trades accuracy for latency.
+DEFAULT_QUALITY_LEVELS = [
+    {"imgsz": 640, "emotion": True, "age_tta": True, "face_attributes": True},
+    {"imgsz": 480, "emotion": True, "age_tta": True, "face_attributes": True},
+    {"imgsz": 480, "emotion": False, "age_tta": True, "face_attributes": True},
+    {"imgsz": 416, "emotion": False, "age_tta": False, "face_attributes": True},
+    {"imgsz": 320, "emotion": False, "age_tta": False, "face_attributes": False},
+]
+QUALITY_LEVELS = json.loads(os.environ["QUALITY_LEVELS"]) if "QUALITY_LEVELS" in os.environ else DEFAULT_QUALITY_LEVELS
+
+LOAD_MAX_QUEUE = int(os.environ.get("LOAD_MAX_QUEUE", "4"))  # calls waiting or running before stepping down
+LOAD_TARGET_LATENCY = float(os.environ.get("LOAD_TARGET_LATENCY", "1.0"))  # p90 seconds per inference call
+LOAD_STEP_INTERVAL = float(os.environ.get("LOAD_STEP_INTERVAL", "2.0"))  # min seconds between level changes
+
+# ================== Governor ==================
+class LoadGovernor:
+    """Steps quality down under backpressure (queue depth or p90 latency) and back up once load falls."""
+
+    def __init__(self, levels=QUALITY_LEVELS, max_queue=LOAD_MAX_QUEUE, target_latency=LOAD_TARGET_LATENCY,
+                 step_interval=LOAD_STEP_INTERVAL, window=50):
+        self.levels = levels
+        self.max_queue = max_queue
+        self.target_latency = target_latency
+        self.step_interval = step_interval
+        self.latencies = deque(maxlen=window)
+        self.in_flight = 0
+        self.level = 0
+        self.last_step = 0.0
+        self.lock = threading.Lock()
+
+    def quality(self):
+        with self.lock:
+            self._adjust()
+            return self.level, self.levels[self.level]
+
+    @contextmanager
+    def track(self):
+        with self.lock:
+            self.in_flight += 1
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+                self.latencies.append(time.perf_counter() - start)
+                self._adjust()
+
+    def p90_latency(self):
+        if not self.latencies:
+            return 0.0
+        ordered = sorted(self.latencies)
+        return ordered[int(0.9 * (len(ordered) - 1))]
+
+    def _adjust(self):
+        now = time.monotonic()
+        if now - self.last_step < self.step_interval:
+            return
+        p90 = self.p90_latency()
+        overloaded = self.in_flight > self.max_queue or p90 > self.target_latency
+        relieved = (self.in_flight <= self.max_queue // 2 and len(self.latencies) >= 5
+                    and p90 < 0.5 * self.target_latency)
+        if overloaded and self.level < len(self.levels) - 1:
+            self.level += 1
+        elif relieved and self.level > 0:
+            self.level -= 1
+        else:
+            return
+        self.last_step = now
+        # Latencies measured at the old level no longer describe the new one
+        self.latencies.clear()
+        logger.info(f"Quality level -> {self.level} (in flight: {self.in_flight}, p90: {p90:.3f}s)")
+
+    def stats(self):
+        with self.lock:
+            return {"level": self.level, "in_flight": self.in_flight, "p90_latency": round(self.p90_latency(), 4)}
@@ -0,0 +1,247 @@
+import os
+import sys
+import hmac
+import json
+import time
+import uuid
+import pstats
+import cProfile
+import logging
+import threading
+import functools
+import contextvars
+from collections import Counter, OrderedDict
+from contextlib import nullcontext
+
+logger = logging.getLogger(__name__)
+
+# ================== Configuration ==================
+# Profiling is off unless an admin token is configured; with it off, span() is a ContextVar lookup
+PROFILING_TOKEN = os.environ.get("PROFILING_TOKEN", "")
+PROFILING_ENABLED = bool(PROFILING_TOKEN)
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "profiles")
+PROFILE_KEEP = int(os.environ.get("PROFILE_KEEP", "20"))  # request traces kept on disk
+PROFILE_MAX_SECONDS = 60  # longest on-demand stack sampling window
+PROFILE_MIN_INTERVAL = 0.001  # shortest pause between stack samples; less would hold the GIL in a busy loop
+PROFILERS = ("trace", "cprofile", "torch")  # values of the X-Profile request header
+
+_trace = contextvars.ContextVar("trace", default=None)
+_parent = contextvars.ContextVar("parent_span", default=None)
+_NOOP = nullcontext()
+_sampling = threading.Lock()
+
+# ================== Helpers ==================
+def is_admin(conn):
+    # Bytes: compare_digest raises TypeError on non-ASCII str
+    token = conn.headers.get("x-admin-token", "").encode()
+    return PROFILING_ENABLED and hmac.compare_digest(token, PROFILING_TOKEN.encode())
+
+def span(name):
+    trace = _trace.get()
+    if trace is None:
+        return _NOOP
+    return Span(trace, name)
+
+def profiled(fn):
+    # Runs fn under the request's cProfile / torch profiler in whichever thread ends up calling it
+    trace = _trace.get()
+    if trace is None or trace.profiler == "trace":
+        return fn
+    return functools.partial(trace.run_profiled, fn)
+
+def write_folded(path, stacks):
+    # Collapsed-stack format ("root;child;leaf value"), read by flamegraph.pl, speedscope and inferno
+    with open(path, "w") as f:
+        for stack, value in sorted(stacks.items()):
+            if value > 0:
+                f.write(f"{stack} {int(value)}\n")
+    return path
+
+# ================== Request Traces ==================
+class Span:
+    __slots__ = ("trace", "name", "path", "parent", "start", "child_seconds", "token")
+
+    def __init__(self, trace, name):
+        self.trace = trace
+        self.name = name
+        self.child_seconds = 0.0
+
+    def __enter__(self):
+        self.parent = _parent.get()
+        self.path = f"{self.parent.path};{self.name}" if self.parent is not None else self.name
+        self.token = _parent.set(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        end = time.perf_counter()
+        _parent.reset(self.token)
+        duration = end - self.start
+        if self.parent is not None:
+            self.parent.child_seconds += duration
+        self.trace.record(self, end)
+        return False
+
+class Trace:
+    """Spans (and optionally cProfile / torch profiler output) collected for one request.
+
+    The trace lives in a ContextVar, so spans opened in the threadpool or in a scheduler worker
+    nest under the request that submitted the work.
+    """
+
+    def __init__(self, name, profiler="trace"):
+        self.id = uuid.uuid4().hex
+        self.name = name
+        self.profiler = profiler
+        self.started = time.perf_counter()
+        self.spans = []  # (path, name, start, end, self seconds, thread id, thread name)
+        self.profiles = []
+        self.torch_stacks = []
+        self.lock = threading.Lock()
+
+    def record(self, span, end):
+        thread = threading.current_thread()
+        self_seconds = end - span.start - span.child_seconds
+        self.spans.append((span.path, span.name, span.start, end, self_seconds, thread.ident, thread.name))
+
+    def run_profiled(self, fn, *args, **kwargs):
+        if self.profiler == "torch":
+            return self._run_torch(fn, *args, **kwargs)
+        prof = cProfile.Profile()
+        try:
+            prof.enable()
+        except ValueError:
+            # Another profiler is already active in this thread
+            return fn(*args, **kwargs)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            prof.disable()
+            with self.lock:
+                self.profiles.append(prof)
+
+    def _run_torch(self, fn, *args, **kwargs):
+        from torch.profiler import profile, ProfilerActivity
+        with profile(activities=[ProfilerActivity.CPU], with_stack=True) as prof:
+            result = fn(*args, **kwargs)
+        with self.lock:
+            path = os.path.join(PROFILE_DIR, f".{self.id}-torch-{len(self.torch_stacks)}.folded")
+            self.torch_stacks.append(path)
+        prof.export_stacks(path, "self_cpu_time_total")
+        return result
+
+    def activate(self):
+        return _trace.set(self), _parent.set(None)
+
+    @staticmethod
+    def deactivate(tokens):
+        trace_token, parent_token = tokens
+        _parent.reset(parent_token)
+        _trace.reset(trace_token)
+
+    def summary(self):
+        totals = {}
+        for _, name, start, end, _, _, _ in self.spans:
+            totals[name] = totals.get(name, 0.0) + (end - start)
+        return {"id": self.id, "name": self.name, "profiler": self.profiler,
+                "spans": {name: round(seconds, 6) for name, seconds in sorted(totals.items(), key=lambda kv: -kv[1])}}
+
+    def chrome_trace(self):
+        # Trace Event Format, opened by chrome://tracing, Perfetto and speedscope
+        events = []
+        threads = {}
+        for _, name, start, end, _, tid, thread_name in self.spans:
+            threads[tid] = thread_name
+            events.append({"name": name, "ph": "X", "pid": 1, "tid": tid,
+                           "ts": round((start - self.started) * 1e6, 3), "dur": round((end - start) * 1e6, 3)})
+        for tid, thread_name in threads.items():
+            events.append({"name": "thread_name", "ph": "M", "pid": 1, "tid": tid, "args": {"name": thread_name}})
+        return {"traceEvents": events, "displayTimeUnit": "ms", "otherData": {"request": self.name}}
+
+    def folded(self):
+        stacks = Counter()
+        for path, _, _, _, self_seconds, _, _ in self.spans:
+            stacks[path] += self_seconds * 1e6  # microseconds
+        return stacks
+
+class TraceStore:
+    """Writes finished traces to PROFILE_DIR and keeps the newest `keep` of them."""
+
+    FORMATS = {"chrome": ".trace.json", "folded": ".folded", "cprofile": ".prof", "torch": ".torch.folded"}
+
+    def __init__(self, directory=PROFILE_DIR, keep=PROFILE_KEEP):
+        self.directory = directory
+        self.keep = keep
+        self.traces = OrderedDict()
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, trace_id, fmt):
+        return os.path.join(self.directory, trace_id + self.FORMATS[fmt])
+
+    def save(self, trace):
+        summary = trace.summary()
+        summary["seconds"] = round(time.perf_counter() - trace.started, 6)
+        with open(self.path(trace.id, "chrome"), "w") as f:
+            json.dump(trace.chrome_trace(), f)
+        write_folded(self.path(trace.id, "folded"), trace.folded())
+        formats = ["chrome", "folded"]
+        if trace.profiles:
+            stats = pstats.Stats(trace.profiles[0])
+            for prof in trace.profiles[1:]:
+                stats.add(prof)
+            stats.dump_stats(self.path(trace.id, "cprofile"))
+            formats.append("cprofile")
+        if trace.torch_stacks:
+            with open(self.path(trace.id, "torch"), "w") as out:
+                for part in trace.torch_stacks:
+                    with open(part) as f:
+                        out.write(f.read())
+                    os.remove(part)
+            formats.append("torch")
+        summary["formats"] = formats
+        with self.lock:
+            self.traces[trace.id] = summary
+            while len(self.traces) > self.keep:
+                old_id, old = self.traces.popitem(last=False)
+                for fmt in old["formats"]:
+                    try:
+                        os.remove(self.path(old_id, fmt))
+                    except OSError:
+                        pass
+        return summary
+
+    def get(self, trace_id):
+        with self.lock:
+            return self.traces.get(trace_id)
+
+    def list(self):
+        with self.lock:
+            return list(reversed(self.traces.values()))
+
+# ================== Stack Sampling ==================
+def sample_stacks(seconds, interval=0.005):
+    """Samples every thread's Python stack for `seconds` and returns collapsed stacks with sample counts."""
+    if not _sampling.acquire(blocking=False):
+        return None  # one sampler at a time
+    try:
+        me = threading.get_ident()
+        stacks = Counter()
+        interval = max(interval, PROFILE_MIN_INTERVAL)
+        deadline = time.perf_counter() + min(seconds, PROFILE_MAX_SECONDS)
+        while time.perf_counter() < deadline:
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                frames = []
+                while frame is not None:
+                    code = frame.f_code
+                    frames.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                frames.append(names.get(ident, str(ident)))
+                stacks[";".join(reversed(frames))] += 1
+            time.sleep(interval)
+        return stacks
+    finally:
+        _sampling.release()
@@ -0,0 +1,115 @@
+import os
+import queue
+import logging
+import threading
+import cv2
+
+logger = logging.getLogger(__name__)
+
+# ================== Configuration ==================
+RENDER_DIR = os.environ.get("RENDER_DIR", "rendered")
+RENDER_KEEP = int(os.environ.get("RENDER_KEEP", "50"))  # newest rendered videos kept on disk
+RENDER_QUEUE_SIZE = 32  # frames buffered between inference and the writer stage
+RENDER_FOURCCS = ("avc1", "mp4v")  # H.264 plays in browsers; mp4v is the fallback every OpenCV build has
+
+# ================== Drawing ==================
+def draw_detections(frame, detections, color=None):
+    for d in detections:
+        # Detection colors are RGB for the clients; OpenCV draws in BGR
+        c = tuple(int(v) for v in (color or d.get("color", (255, 255, 255))))[::-1]
+        x1, y1, x2, y2 = d["x1"], d["y1"], d["x2"], d["y2"]
+        cv2.rectangle(frame, (x1, y1), (x2, y2), c, 2)
+        label = f"{d['label']} {d['conf']:.2f}"
+        (tw, th), _ = cv2.getTextSize(label, cv2.FONT_HERSHEY_SIMPLEX, 0.5, 1)
+        cv2.rectangle(frame, (x1, max(0, y1 - th - 6)), (x1 + tw, y1), c, -1)
+        cv2.putText(frame, label, (x1, max(th, y1 - 4)), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 0, 0), 1)
+    return frame
+
+def draw_caption(frame, text):
+    cv2.putText(frame, text, (10, 24), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 0, 0), 3)
+    cv2.putText(frame, text, (10, 24), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (255, 255, 255), 1)
+    return frame
+
+# ================== Writer Stage ==================
+class VideoRenderWriter(threading.Thread):
+    """Draws detections and encodes an MP4 on its own thread.
+
+    Frames arrive through a bounded queue, so inference only waits on the writer when it falls
+    a full queue behind.
+    """
+
+    def __init__(self, path, fps, queue_size=RENDER_QUEUE_SIZE):
+        super().__init__(daemon=True)
+        self.path = path
+        self.fps = fps or 25.0
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.writer = None
+        self.frames_written = 0
+        self.error = None
+        self.start()
+
+    def write(self, frame, detections, caption=None):
+        if self.error is not None:
+            raise self.error
+        if not frame.flags.writeable:
+            frame = frame.copy()
+        self.queue.put((frame, detections, caption))
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            if self.error is not None:
+                continue  # keep draining so producers never block
+            frame, detections, caption = item
+            try:
+                draw_detections(frame, detections)
+                if caption:
+                    draw_caption(frame, caption)
+                if self.writer is None:
+                    self.writer = self._open_writer(frame.shape[1], frame.shape[0])
+                self.writer.write(frame)
+                self.frames_written += 1
+            except Exception as e:
+                logger.error(f"Render writer failed: {e}")
+                self.error = e
+        if self.writer is not None:
+            self.writer.release()
+
+    def _open_writer(self, width, height):
+        for fourcc in RENDER_FOURCCS:
+            writer = cv2.VideoWriter(self.path, cv2.VideoWriter_fourcc(*fourcc), self.fps, (width, height))
+            if writer.isOpened():
+                return writer
+            writer.release()
+        raise IOError(f"Unable to open video writer for {self.path}")
+
+    def close(self):
+        self.queue.put(None)
+        self.join()
+        if self.error is not None:
+            self._remove_output()
+            raise self.error
+        return self.frames_written
+
+    def abort(self):
+        # The analysis failed: stop the writer thread and drop the truncated video
+        self.error = self.error or IOError("Rendering aborted")
+        self.queue.put(None)
+        self.join()
+        self._remove_output()
+
+    def _remove_output(self):
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+def prune_rendered(directory=RENDER_DIR, keep=RENDER_KEEP):
+    files = [os.path.join(directory, f) for f in os.listdir(directory) if f.endswith(".mp4")]
+    for path in sorted(files, key=os.path.getmtime)[:-keep or None]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
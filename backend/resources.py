@@ -0,0 +1,157 @@
+import os
+import json
+import logging
+
+# Thread budget for every runtime hosted in the backend process. TensorFlow (age), PyTorch (YOLO,
+# emotion, HAR), ONNX Runtime (InsightFace) and OpenCV each default to one thread per core, so
+# under concurrent requests they oversubscribe the CPU. Nothing heavy is imported here: the
+# environment half of the budget has to be set before numpy/torch/TensorFlow are first imported.
+
+logger = logging.getLogger(__name__)
+
+# ================== Configuration ==================
+RESOURCE_CONFIG = os.environ.get("RESOURCE_CONFIG", "resources.json")  # written by tune_resources.py
+
+# ================== Budget ==================
+def cpu_count():
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+def default_budget(cpus=None, workers=None):
+    cpus = cpus or cpu_count()
+    workers = workers or int(os.environ.get("INFERENCE_WORKERS", "1"))
+    intra = max(1, cpus // workers)  # model calls are serialized per inference worker
+    return {
+        "torch_intra_threads": intra,
+        "torch_interop_threads": 1,
+        "tf_intra_threads": intra,
+        "tf_inter_threads": 1,
+        "ort_intra_threads": intra,
+        "opencv_threads": max(1, min(4, cpus // 4)),
+        "inference_cpus": None,  # e.g. "0-7", or "0-3;4-7" for one core set per inference worker (see pin_process)
+    }
+
+def load_budget(path=RESOURCE_CONFIG):
+    """Defaults, overlaid with the tuned config file if present, overlaid with env vars of the same name."""
+    budget = default_budget()
+    if path and os.path.exists(path):
+        with open(path) as f:
+            budget.update({k: v for k, v in json.load(f).items() if k in budget})
+    for key in budget:
+        value = os.environ.get(key.upper())
+        if value:
+            budget[key] = value if key == "inference_cpus" else int(value)
+    return budget
+
+def parse_cpu_sets(spec):
+    # "0-3,8;4-7,9" -> [{0, 1, 2, 3, 8}, {4, 5, 6, 7, 9}]
+    if not spec:
+        return []
+    cpu_sets = []
+    for part in str(spec).split(";"):
+        cpus = set()
+        for item in part.split(","):
+            item = item.strip()
+            if not item:
+                continue
+            start, _, end = item.partition("-")
+            cpus.update(range(int(start), int(end or start) + 1))
+        if cpus:
+            cpu_sets.append(cpus)
+    return cpu_sets
+
+# ================== Applying the Budget ==================
+def set_thread_env(budget):
+    # Read once at library load (OpenMP/MKL pools, TF's default context); explicit env vars win
+    env = {
+        "OMP_NUM_THREADS": budget["torch_intra_threads"],
+        "MKL_NUM_THREADS": budget["torch_intra_threads"],
+        "OPENBLAS_NUM_THREADS": budget["torch_intra_threads"],
+        "TF_NUM_INTRAOP_THREADS": budget["tf_intra_threads"],
+        "TF_NUM_INTEROP_THREADS": budget["tf_inter_threads"],
+    }
+    for key, value in env.items():
+        os.environ.setdefault(key, str(value))
+
+def apply_runtime_threads(budget):
+    """Sets thread pools through each runtime's API; call after import, before any model runs."""
+    import cv2
+    import torch
+    import tensorflow as tf
+
+    cv2.setNumThreads(budget["opencv_threads"])
+    torch.set_num_threads(budget["torch_intra_threads"])
+    try:
+        torch.set_num_interop_threads(budget["torch_interop_threads"])
+    except RuntimeError:
+        pass  # already fixed once any inter-op work has run
+    try:
+        tf.config.threading.set_intra_op_parallelism_threads(budget["tf_intra_threads"])
+        tf.config.threading.set_inter_op_parallelism_threads(budget["tf_inter_threads"])
+    except RuntimeError:
+        logger.warning("TensorFlow was initialized before the thread budget was applied")
+    logger.info(f"Thread budget: {budget}")
+
+def ort_session_options(budget):
+    # Sequential execution never uses the inter-op pool, so only the intra-op size is budgeted
+    import onnxruntime as ort
+    options = ort.SessionOptions()
+    options.intra_op_num_threads = budget["ort_intra_threads"]
+    options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+    return options
+
+def apply_ort_threads(face_app, budget):
+    # insightface's model_zoo only forwards providers to ONNX Runtime, so SessionOptions can't go through
+    # FaceAnalysis; rebuild each session under the budget instead of ORT's one-thread-per-core default
+    import onnxruntime as ort
+    options = ort_session_options(budget)
+    for name, model in face_app.models.items():
+        providers = model.session.get_providers()
+        model.session = ort.InferenceSession(model.model_file, sess_options=options, providers=providers)
+        effective = model.session.get_session_options()
+        logger.info(f"InsightFace {name}: ORT intra-op threads {effective.intra_op_num_threads}, "
+                    f"execution mode {effective.execution_mode}")
+
+def pin_thread(cpus):
+    # Linux applies affinity per thread; pools a pinned thread creates later inherit its core set
+    if not cpus or not hasattr(os, "sched_setaffinity"):
+        return False
+    try:
+        os.sched_setaffinity(0, cpus)
+        return True
+    except OSError as e:
+        logger.warning(f"Could not pin thread to CPUs {sorted(cpus)}: {e}")
+        return False
+
+def pin_process(budget):
+    """Pins the calling thread to every configured core set; call on the main thread before any model loads.
+
+    ONNX Runtime, TensorFlow and OpenMP create their pools on whichever thread loads the models, so
+    this is what keeps them on the configured cores. With one core set that is the whole story; with
+    several, inference_worker_init additionally gives each scheduler worker its own set, which only
+    torch's pools (created by the calling thread) follow.
+    """
+    cpu_sets = parse_cpu_sets(budget["inference_cpus"])
+    if not cpu_sets:
+        return False
+    return pin_thread(set().union(*cpu_sets))
+
+def inference_worker_init(budget):
+    # Scheduler worker initializer pinning worker i to the i-th configured core set (torch only, see pin_process)
+    cpu_sets = parse_cpu_sets(budget["inference_cpus"])
+    if len(cpu_sets) < 2:
+        return None  # a single set is already applied process-wide by pin_process
+
+    def init(index):
+        pin_thread(cpu_sets[index % len(cpu_sets)])
+    return init
+
+def worker_env(threads):
+    # Env overrides giving each of several worker processes an equal share of the host
+    keys = ("torch_intra_threads", "tf_intra_threads", "ort_intra_threads")
+    env = {key.upper(): str(max(1, threads)) for key in keys}
+    env["OPENCV_THREADS"] = "1"
+    return env
+
+RESOURCES = load_budget()
@@ -0,0 +1,148 @@
+import os
+import time
+import logging
+import threading
+import contextvars
+from collections import deque
+from concurrent.futures import Future
+
+logger = logging.getLogger(__name__)
+
+# ================== Configuration ==================
+INFERENCE_WORKERS = int(os.environ.get("INFERENCE_WORKERS", "1"))  # models are not thread-safe; keep at 1 unless replicated
+CLIENT_MAX_IN_FLIGHT = int(os.environ.get("CLIENT_MAX_IN_FLIGHT", "1"))  # running calls per client
+CLASS_WEIGHTS = {"interactive": 4.0, "bulk": 1.0}
+IDLE_CLIENT_SECONDS = 300  # stats for clients idle longer than this are dropped
+
+# ================== Scheduler ==================
+class Task:
+    __slots__ = ("fn", "args", "kwargs", "ctx", "mode", "request_class", "weight", "charged", "future", "enqueued_at")
+
+    def __init__(self, fn, args, kwargs, mode, request_class):
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.ctx = contextvars.copy_context()
+        self.mode = mode
+        self.request_class = request_class
+        self.weight = CLASS_WEIGHTS.get(request_class, 1.0)  # per call: one client may send both classes
+        self.charged = 0.0  # estimated cost charged at dispatch
+        self.future = Future()
+        self.enqueued_at = time.perf_counter()
+
+class ClientState:
+    def __init__(self, client_id):
+        self.client_id = client_id
+        self.queue = deque()
+        self.in_flight = 0
+        self.vtime = 0.0  # weighted inference seconds consumed
+        self.served = {}  # calls completed, by request class
+        self.busy_seconds = 0.0
+        self.delays = deque(maxlen=100)
+        self.last_seen = time.monotonic()
+
+class FairScheduler:
+    """Weighted fair queueing of model calls across clients.
+
+    Each client is charged the inference time of every call divided by that call's class weight, and the
+    eligible client with the least charge runs next. Clients returning from idle start at the
+    current minimum so they cannot bank credit. Charges are estimated per mode at dispatch and
+    corrected with the measured time when the call finishes.
+    """
+
+    def __init__(self, workers=INFERENCE_WORKERS, max_in_flight=CLIENT_MAX_IN_FLIGHT, worker_init=None):
+        self.max_in_flight = max_in_flight
+        self.worker_init = worker_init  # called with the worker index on each worker thread, e.g. CPU pinning
+        self.clients = {}
+        self.mode_cost = {}  # EWMA seconds per call, by mode
+        self.cond = threading.Condition()
+        self.last_prune = time.monotonic()
+        self.workers = [threading.Thread(target=self._worker, args=(i,), daemon=True, name=f"inference-{i}")
+                        for i in range(workers)]
+        for w in self.workers:
+            w.start()
+
+    def submit(self, client_id, request_class, mode, fn, *args, **kwargs):
+        task = Task(fn, args, kwargs, mode, request_class)
+        with self.cond:
+            now = time.monotonic()
+            if now - self.last_prune > IDLE_CLIENT_SECONDS / 10:
+                self._prune_idle(now)
+            client = self.clients.get(client_id)
+            if client is None:
+                client = self.clients[client_id] = ClientState(client_id)
+            if not client.queue and client.in_flight == 0:
+                client.vtime = max(client.vtime, self._min_active_vtime())
+            client.last_seen = now
+            client.queue.append(task)
+            self.cond.notify()
+        return task.future
+
+    def _prune_idle(self, now):
+        # Per-session keys (websockets) would otherwise accumulate without bound
+        self.last_prune = now
+        for client_id in [k for k, c in self.clients.items()
+                          if not c.queue and not c.in_flight and now - c.last_seen > IDLE_CLIENT_SECONDS]:
+            del self.clients[client_id]
+
+    def _min_active_vtime(self):
+        active = [c.vtime for c in self.clients.values() if c.queue or c.in_flight]
+        return min(active) if active else 0.0
+
+    def _next_task(self):
+        eligible = [c for c in self.clients.values() if c.queue and c.in_flight < self.max_in_flight]
+        if not eligible:
+            return None, None
+        client = min(eligible, key=lambda c: c.vtime)
+        task = client.queue.popleft()
+        client.in_flight += 1
+        task.charged = self.mode_cost.get(task.mode, 0.0)
+        client.vtime += task.charged / task.weight
+        client.delays.append(time.perf_counter() - task.enqueued_at)
+        return client, task
+
+    def _worker(self, index):
+        if self.worker_init is not None:
+            self.worker_init(index)
+        while True:
+            with self.cond:
+                client, task = self._next_task()
+                while task is None:
+                    self.cond.wait()
+                    client, task = self._next_task()
+            started = time.perf_counter()
+            try:
+                if task.future.set_running_or_notify_cancel():
+                    task.future.set_result(task.ctx.run(task.fn, *task.args, **task.kwargs))
+            except BaseException as e:
+                task.future.set_exception(e)
+            elapsed = time.perf_counter() - started
+            with self.cond:
+                estimate = self.mode_cost.get(task.mode, 0.0)
+                self.mode_cost[task.mode] = elapsed if task.mode not in self.mode_cost else 0.8 * estimate + 0.2 * elapsed
+                client.vtime += (elapsed - task.charged) / task.weight
+                client.in_flight -= 1
+                client.served[task.request_class] = client.served.get(task.request_class, 0) + 1
+                client.busy_seconds += elapsed
+                client.last_seen = time.monotonic()
+                self.cond.notify_all()
+
+    def queued(self):
+        with self.cond:
+            return sum(len(c.queue) + c.in_flight for c in self.clients.values())
+
+    def stats(self):
+        with self.cond:
+            self._prune_idle(time.monotonic())
+            clients = {}
+            for client_id, c in self.clients.items():
+                delays = sorted(c.delays)
+                clients[client_id] = {
+                    "queued": len(c.queue),
+                    "in_flight": c.in_flight,
+                    "served": dict(c.served),
+                    "busy_seconds": round(c.busy_seconds, 4),
+                    "queue_delay_avg": round(sum(delays) / len(delays), 4) if delays else 0.0,
+                    "queue_delay_p95": round(delays[int(0.95 * (len(delays) - 1))], 4) if delays else 0.0,
+                }
+            return {"clients": clients, "mode_cost": {m: round(v, 4) for m, v in self.mode_cost.items()}}
@@ -2,6 +2,9 @@ import streamlit as st
 import cv2
 import logging
 import time
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import os
 from ultralytics import YOLO
@@ -9,6 +12,15 @@ import numpy as np
 import base64
 from io import BytesIO
 from PIL import Image
+from frame_cache import FrameCache, DecodedFrames, FRAME_CACHE_DIR, FRAME_CACHE_MAX_BYTES
+
+DECODE_MAX_SIDE = 1280  # Frames are scaled to this longest side while decoding
+DISPLAY_FPS = 15  # Dashboard refresh rate; inference runs as fast as the model allows
+DISPLAY_WIDTH = 960  # Frames are downscaled to this width before being sent to the browser
+MULTI_MAX_BATCH = 8  # Most frames per shared-model batch in multi-stream mode
+MULTI_COLUMNS = 3
+# Playback decodes every frame of the whole file, so caching it costs GBs per clip; opt in for repeated replays
+PLAYBACK_FRAME_CACHE = os.environ.get("PLAYBACK_FRAME_CACHE", "0") == "1"
 
 # ---------- Logging Setup ----------
 logger = logging.getLogger(__name__)
@@ -28,75 +40,194 @@ def get_image_download_link(img, filename):
     href = f'<a href="data:image/jpeg;base64,{img_str}" download="{filename}">Download {filename}</a>'
     return href
 
+# ---------- Snapshots (written off the detection loop) ----------
+def save_snapshot(frame, snapshot_path):
+    cv2.imwrite(snapshot_path, frame)
+    img = Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+    logger.info(f"Snapshot taken: {snapshot_path}")
+    return get_image_download_link(img, os.path.basename(snapshot_path))
+
+# ---------- Threaded Capture ----------
+def open_frame_source(source):
+    # Uploaded files can go through the decoded-frame cache; live cameras are always decoded
+    if PLAYBACK_FRAME_CACHE and isinstance(source, str) and "://" not in source and FRAME_CACHE_MAX_BYTES > 0:
+        return FrameCache(FRAME_CACHE_DIR, FRAME_CACHE_MAX_BYTES).open(source, max_side=DECODE_MAX_SIDE)
+    return DecodedFrames(source, max_side=DECODE_MAX_SIDE)
+
+class FrameGrabber(threading.Thread):
+    """Reads frames on a background thread.
+
+    Live sources keep only the newest frame so inference never works on a stale backlog;
+    files are buffered in a small queue so no frame is skipped. Passing live=True for a
+    file plays it back at its native frame rate, as a camera would deliver it.
+    """
+
+    def __init__(self, source, buffer_size=4, live=None):
+        super().__init__(daemon=True)
+        self.frames = open_frame_source(source)
+        is_stream = not isinstance(source, str) or "://" in source
+        self.live = is_stream if live is None else live
+        self.paced = self.live and not is_stream
+        self.queue = queue.Queue(maxsize=1 if self.live else buffer_size)
+        self.stopped = threading.Event()
+        self.finished = threading.Event()
+        self.error = None
+        self.captured = 0
+        self.dropped = 0
+
+    def run(self):
+        frame_iter = iter(self.frames)
+        start = time.time()
+        try:
+            for _, frame in frame_iter:
+                if self.stopped.is_set():
+                    break
+                if self.paced and self.frames.fps > 0:
+                    delay = start + self.captured / self.frames.fps - time.time()
+                    if delay > 0:
+                        time.sleep(delay)
+                self.captured += 1
+                item = (frame, time.time())
+                if self.live:
+                    try:
+                        self.queue.get_nowait()
+                        self.dropped += 1
+                    except queue.Empty:
+                        pass
+                    self.queue.put(item)
+                else:
+                    while not self.stopped.is_set():
+                        try:
+                            self.queue.put(item, timeout=0.1)
+                            break
+                        except queue.Full:
+                            continue
+        except IOError as e:
+            self.error = e
+        finally:
+            frame_iter.close()
+            self.finished.set()
+
+    def read(self, timeout=0.1):
+        # Returns the next (frame, capture time), or None once the source is exhausted
+        while True:
+            try:
+                return self.queue.get(timeout=timeout)
+            except queue.Empty:
+                if self.finished.is_set() and self.queue.empty():
+                    return None
+
+    def read_nowait(self):
+        try:
+            return self.queue.get_nowait()
+        except queue.Empty:
+            return None
+
+    @property
+    def exhausted(self):
+        return self.finished.is_set() and self.queue.empty()
+
+    def stop(self):
+        self.stopped.set()
+        self.join(timeout=2)
+
+def face_boxes(result, conf_threshold=0.3):
+    xyxy = result.boxes.xyxy.cpu().numpy()
+    conf = result.boxes.conf.cpu().numpy()
+    cls = result.boxes.cls.cpu().numpy()
+    keep = (cls == 0) & (conf > conf_threshold)
+    return xyxy[keep], conf[keep]
+
+def draw_boxes(frame, boxes, confidences, scale=1.0):
+    for (x1, y1, x2, y2), conf in zip((boxes * scale).astype(int), confidences):
+        cv2.rectangle(frame, (x1, y1), (x2, y2), (0, 255, 0), 2)
+        cv2.putText(frame, f"Conf: {conf:.2f}", (x1, y1 - 5), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0,255,0), 1)
+    return frame
+
 # ---------- Face Detection Runner ----------
-def run_detection(source, model):
+def run_detection(source, model, display_fps=DISPLAY_FPS, display_width=DISPLAY_WIDTH):
     stframe = st.empty()
     metrics = st.empty()
     snapshot_container = st.empty()
 
-    cap = cv2.VideoCapture(source)
-    if not cap.isOpened():
-        st.error("Unable to open video source")
-        logger.error("Failed to open video/camera")
-        return
+    grabber = FrameGrabber(source)
+    grabber.start()
+    snapshot_pool = ThreadPoolExecutor(max_workers=1)
+    snapshot_future = None
 
     frame_count = 0
+    displayed = 0
+    inference_time = 0.0
     # total_faces_detected = 0
     start_time = time.time()
     last_snapshot_time = start_time
     snapshot_interval = 10
     log_interval = 2
     last_log_time = start_time
+    last_display_time = 0.0
 
     stop_button = st.sidebar.button("⛔ Stop Processing")
 
-    while cap.isOpened() and not stop_button:
-        ret, frame = cap.read()
-        if not ret:
+    while not stop_button:
+        item = grabber.read()
+        if item is None:
+            if grabber.error is not None:
+                st.error("Unable to open video source")
+                logger.error("Failed to open video/camera")
+                snapshot_pool.shutdown(wait=False)
+                return
             st.warning("No more frames or failed to grab frame.")
             break
+        frame, _ = item
 
-        results = model(frame)
-        faces = 0
-        for result in results:
-            boxes = result.boxes.xyxy
-            confidences = result.boxes.conf
-            class_ids = result.boxes.cls
-            for box, conf, cls in zip(boxes, confidences, class_ids):
-                if int(cls) == 0 and conf > 0.3:
-                    x1, y1, x2, y2 = map(int, box)
-                    faces += 1
-                    cv2.rectangle(frame, (x1, y1), (x2, y2), (0, 255, 0), 2)
-                    cv2.putText(frame, f"Conf: {conf:.2f}", (x1, y1 - 5), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0,255,0), 1)
+        t0 = time.time()
+        results = model(frame, verbose=False)
+        inference_time += time.time() - t0
+        boxes, confidences = face_boxes(results[0])
+        faces = len(boxes)
 
         # total_faces_detected += faces
         frame_count += 1
         current_time = time.time()
 
         if current_time - last_log_time >= log_interval:
-            fps = frame_count / (current_time - start_time)
+            elapsed = current_time - start_time
+            capture_fps = grabber.captured / elapsed
+            inference_fps = frame_count / max(inference_time, 1e-9)
+            display_fps_actual = displayed / elapsed
             # metrics.markdown(f"**FPS:** {fps:.2f} &nbsp; | &nbsp; **Faces this frame:** {faces} &nbsp; | &nbsp; **Total Faces:** {total_faces_detected}")
-            metrics.markdown(f"**FPS:** {fps:.2f} &nbsp; | &nbsp; **Faces this frame:** {faces}")
+            metrics.markdown(f"**Capture FPS:** {capture_fps:.2f} &nbsp; | &nbsp; **Inference FPS:** {inference_fps:.2f} "
+                             f"&nbsp; | &nbsp; **Display FPS:** {display_fps_actual:.2f} &nbsp; | &nbsp; "
+                             f"**Dropped:** {grabber.dropped} &nbsp; | &nbsp; **Faces this frame:** {faces}")
 
             last_log_time = current_time
 
         # Snapshot every 10 seconds
-        if current_time - last_snapshot_time >= snapshot_interval:
+        if current_time - last_snapshot_time >= snapshot_interval and snapshot_future is None:
             snap_name = f"snapshot_{datetime.now().strftime('%Y%m%d_%H%M%S')}.jpg"
             snapshot_path = os.path.join("Data", snap_name)
-            cv2.imwrite(snapshot_path, frame)
-            img = Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
-            snapshot_container.markdown(get_image_download_link(img, snap_name), unsafe_allow_html=True)
+            snapshot_future = snapshot_pool.submit(save_snapshot, draw_boxes(frame.copy(), boxes, confidences), snapshot_path)
             last_snapshot_time = current_time
-            logger.info(f"Snapshot taken: {snapshot_path}")
-
-        # Display Frame
-        rgb_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-        stframe.image(rgb_frame, channels="RGB", use_container_width=True)
+        if snapshot_future is not None and snapshot_future.done():
+            snapshot_container.markdown(snapshot_future.result(), unsafe_allow_html=True)
+            snapshot_future = None
 
-        time.sleep(0.03)
+        # Display Frame (throttled, at reduced resolution)
+        if current_time - last_display_time >= 1.0 / display_fps:
+            h, w = frame.shape[:2]
+            scale = min(1.0, display_width / float(w))
+            small = cv2.resize(frame, (int(w * scale), int(h * scale)), interpolation=cv2.INTER_AREA) if scale < 1.0 else frame.copy()
+            draw_boxes(small, boxes, confidences, scale)
+            stframe.image(cv2.cvtColor(small, cv2.COLOR_BGR2RGB), channels="RGB", use_container_width=True)
+            displayed += 1
+            last_display_time = current_time
 
-    cap.release()
+    grabber.stop()
+    snapshot_pool.shutdown(wait=True)
+    cache_stats = grabber.frames.stats()
+    if cache_stats["hit"]:
+        st.info(f"Frame cache hit: saved {cache_stats['decode_seconds_saved']:.2f}s of decoding")
+    logger.info(f"Frame cache: {cache_stats}")
     end_time = time.time()
     avg_fps = frame_count / (end_time - start_time)
     # st.success(f"✅ Detection Completed\n\n**Total Frames:** {frame_count}\n**Total Faces Detected:** {total_faces_detected}\n**Average FPS:** {avg_fps:.2f}")
@@ -104,6 +235,89 @@ def run_detection(source, model):
 
     logger.info("Detection complete")
 
+# ---------- Multi-Stream Runner ----------
+def parse_sources(text):
+    sources = []
+    for line in text.splitlines():
+        line = line.strip()
+        if line:
+            sources.append(int(line) if line.isdigit() else line)  # digits are camera indices
+    return sources
+
+def run_multi_detection(sources, model, max_batch=MULTI_MAX_BATCH, display_fps=DISPLAY_FPS, columns=MULTI_COLUMNS):
+    # Every stream shares one model; the newest frame of each stream is batched round-robin
+    grabbers = [FrameGrabber(src, live=True) for src in sources]
+    for g in grabbers:
+        g.start()
+
+    cols = st.columns(min(columns, len(sources)))
+    tiles = []
+    for i, src in enumerate(sources):
+        col = cols[i % len(cols)]
+        tiles.append((col.empty(), col.empty()))
+    summary = st.empty()
+
+    n = len(sources)
+    processed = [0] * n
+    latency_sum = [0.0] * n
+    last_latency = [0.0] * n
+    last_display = [0.0] * n
+    batches = 0
+    next_stream = 0
+    start_time = time.time()
+    tile_width = DISPLAY_WIDTH // len(cols)
+
+    stop_button = st.sidebar.button("⛔ Stop Processing")
+
+    while not stop_button and not all(g.exhausted for g in grabbers):
+        batch = []
+        for k in range(n):
+            i = (next_stream + k) % n
+            item = grabbers[i].read_nowait()
+            if item is not None:
+                batch.append((i, item[0], item[1]))
+            if len(batch) == max_batch:
+                break
+        next_stream = (next_stream + 1) % n
+        if not batch:
+            time.sleep(0.005)
+            continue
+
+        results = model([frame for _, frame, _ in batch], verbose=False)
+        batches += 1
+        now = time.time()
+
+        for (i, frame, captured_at), result in zip(batch, results):
+            boxes, confidences = face_boxes(result)
+            processed[i] += 1
+            last_latency[i] = now - captured_at
+            latency_sum[i] += last_latency[i]
+
+            if now - last_display[i] >= 1.0 / display_fps:
+                h, w = frame.shape[:2]
+                scale = min(1.0, tile_width / float(w))
+                small = cv2.resize(frame, (int(w * scale), int(h * scale)), interpolation=cv2.INTER_AREA) if scale < 1.0 else frame.copy()
+                draw_boxes(small, boxes, confidences, scale)
+                image_slot, caption_slot = tiles[i]
+                image_slot.image(cv2.cvtColor(small, cv2.COLOR_BGR2RGB), channels="RGB", use_container_width=True)
+                elapsed = now - start_time
+                caption_slot.caption(f"**{sources[i]}** | FPS: {processed[i] / elapsed:.1f} | "
+                                     f"Latency: {last_latency[i] * 1000:.0f} ms | Dropped: {grabbers[i].dropped} | "
+                                     f"Faces: {len(boxes)}")
+                last_display[i] = now
+
+        summary.markdown(f"**Streams:** {n} &nbsp; | &nbsp; **Batches:** {batches} &nbsp; | &nbsp; "
+                         f"**Total FPS:** {sum(processed) / (now - start_time):.2f}")
+
+    for g in grabbers:
+        g.stop()
+    for i, g in enumerate(grabbers):
+        if g.error is not None:
+            st.error(f"Unable to open video source: {sources[i]}")
+        avg_latency = latency_sum[i] / processed[i] if processed[i] else 0.0
+        logger.info(f"Stream {sources[i]}: {processed[i]} frames, {g.dropped} dropped, avg latency {avg_latency:.3f}s")
+    st.success(f"✅ Multi-stream detection stopped after {batches} batches")
+
 # ---------- Main App ----------
 def main():
     st.set_page_config(page_title="YOLOv8 Face Detection", layout="wide")
@@ -123,7 +337,7 @@ def main():
 
     # Sidebar input method
     st.sidebar.header("🎛️ Settings")
-    input_choice = st.sidebar.radio("Choose Input Source", ["📁 Upload Video", "📷 Use Webcam"])
+    input_choice = st.sidebar.radio("Choose Input Source", ["📁 Upload Video", "📷 Use Webcam", "🧩 Multi-Stream"])
 
     if input_choice == "📁 Upload Video":
         uploaded_file = st.sidebar.file_uploader("Upload Video", type=["mp4", "avi", "mov"])
@@ -139,5 +353,11 @@ def main():
         if st.sidebar.button("📷 Start Webcam Detection"):
             run_detection(0, model)  # 0 is default webcam
 
+    elif input_choice == "🧩 Multi-Stream":
+        sources_text = st.sidebar.text_area("Sources (one per line: camera index, file path or rtsp:// URL)", "0")
+        sources = parse_sources(sources_text)
+        if sources and st.sidebar.button("▶ Start Multi-Stream Detection"):
+            run_multi_detection(sources, model)
+
 if __name__ == "__main__":
     main()
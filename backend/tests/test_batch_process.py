@@ -0,0 +1,52 @@
+import cv2
+import numpy as np
+from batch_process import JsonlWriter, collect_files, iter_prefetched, load_checkpoint
+
+def write_images(tmp_path, count):
+    paths = []
+    for i in range(count):
+        path = str(tmp_path / f"img{i}.png")
+        cv2.imwrite(path, np.full((8, 8, 3), i, dtype=np.uint8))
+        paths.append(path)
+    return paths
+
+def test_jsonl_writer_returns_written_records_and_tolerates_a_cut_line(tmp_path):
+    output = str(tmp_path / "out.jsonl")
+    writer = JsonlWriter(output)
+    records = [{"path": "/a.jpg"}, {"path": "/b.jpg"}]
+    assert writer.write(records) == records
+    assert writer.close() == []
+    with open(output, "a") as f:
+        f.write('{"path": "/c.j')  # crash mid-line
+    assert JsonlWriter.written_paths(output) == {"/a.jpg", "/b.jpg"}
+
+def test_load_checkpoint(tmp_path):
+    path = tmp_path / "out.done"
+    assert load_checkpoint(str(path)) == set()
+    path.write_text("/a.jpg\n\n/b.jpg\n")
+    assert load_checkpoint(str(path)) == {"/a.jpg", "/b.jpg"}
+
+def test_collect_files_filters_by_extension(tmp_path):
+    images = write_images(tmp_path, 2)
+    (tmp_path / "notes.txt").write_text("x")
+    assert collect_files([str(tmp_path)]) == sorted(images)
+
+def test_prefetch_keeps_file_order_and_survives_bad_files(tmp_path):
+    paths = write_images(tmp_path, 4)
+    bad = tmp_path / "bad.png"
+    bad.write_bytes(b"not an image")
+    paths.insert(1, str(bad))
+    seen = []
+    for path, frames in iter_prefetched(paths, stride=1, use_cache=False, threads=2, depth=2):
+        try:
+            seen.append((path, [frame[0, 0, 0] for _, frame, _ in frames]))
+        except ValueError:
+            seen.append((path, None))
+    assert [p for p, _ in seen] == paths
+    assert seen[1][1] is None
+    assert [v for _, v in seen if v is not None] == [[0], [1], [2], [3]]
+
+def test_prefetch_drains_a_file_the_consumer_skips(tmp_path):
+    paths = write_images(tmp_path, 3)
+    seen = [path for path, _ in iter_prefetched(paths, stride=1, use_cache=False, threads=1, depth=1)]
+    assert seen == paths
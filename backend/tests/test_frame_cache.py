@@ -0,0 +1,95 @@
+import os
+import time
+import cv2
+import numpy as np
+from frame_cache import FrameCache, FRAMES_FILE, META_FILE, TMP_PREFIX
+
+def write_video(path, frames=12, size=(64, 48)):
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*"MJPG"), 10.0, size)
+    assert writer.isOpened()
+    for i in range(frames):
+        writer.write(np.full((size[1], size[0], 3), i * 20, dtype=np.uint8))
+    writer.release()
+
+def make_entry(cache, name, size, age):
+    entry_dir = os.path.join(cache.root, name)
+    os.makedirs(entry_dir)
+    with open(os.path.join(entry_dir, FRAMES_FILE), "wb") as f:
+        f.write(b"\0" * size)
+    meta_path = os.path.join(entry_dir, META_FILE)
+    with open(meta_path, "w") as f:
+        f.write("{}")
+    stamp = time.time() - age
+    os.utime(meta_path, (stamp, stamp))
+    return entry_dir
+
+def test_key_separates_parameters_and_backends():
+    base = FrameCache.key("abc", stride=5, max_side=640, backend="pyav")
+    assert base == "abc_s5_m640_n0_pyav"
+    assert FrameCache.key("abc", stride=5, max_side=640, backend="ffmpeg") != base
+    assert FrameCache.key("abc", stride=5, max_side=640, backend="pyav", keyframes_only=True) == base + "_k"
+    assert FrameCache.key("abc", stride=1, max_side=640, backend="pyav") != base
+
+def test_evict_removes_least_recently_used_first(tmp_path):
+    cache = FrameCache(str(tmp_path), max_bytes=250)
+    old = make_entry(cache, "old", 100, age=300)
+    mid = make_entry(cache, "mid", 100, age=200)
+    new = make_entry(cache, "new", 100, age=100)
+    cache.evict()
+    assert not os.path.exists(old)
+    assert os.path.exists(mid) and os.path.exists(new)
+
+def test_evict_keeps_the_entry_just_committed(tmp_path):
+    cache = FrameCache(str(tmp_path), max_bytes=150)
+    old = make_entry(cache, "old", 100, age=300)
+    newer = make_entry(cache, "newer", 100, age=100)
+    cache.evict(keep=old)
+    assert os.path.exists(old)
+    assert not os.path.exists(newer)
+
+def test_stale_tmp_dirs_are_swept(tmp_path):
+    stale = tmp_path / f"{TMP_PREFIX}stale"
+    live = tmp_path / f"{TMP_PREFIX}live"
+    for d in (stale, live):
+        d.mkdir()
+        (d / FRAMES_FILE).write_bytes(b"\0" * 10)
+    stamp = time.time() - 7200
+    os.utime(stale / FRAMES_FILE, (stamp, stamp))
+    FrameCache(str(tmp_path))
+    assert not stale.exists()
+    assert live.exists()
+
+def test_miss_stores_frames_and_hit_reads_them_back(tmp_path):
+    video = str(tmp_path / "clip.avi")
+    write_video(video)
+    cache = FrameCache(str(tmp_path / "cache"), max_bytes=1 << 30)
+
+    miss = cache.open(video, stride=3, backend="opencv")
+    assert not miss.hit
+    decoded = [(n, f.copy()) for n, f in miss]
+    assert [n for n, _ in decoded] == [0, 3, 6, 9]
+
+    hit = cache.open(video, stride=3, backend="opencv")
+    assert hit.hit
+    cached = list(hit)
+    assert [n for n, _ in cached] == [0, 3, 6, 9]
+    for (_, a), (_, b) in zip(decoded, cached):
+        np.testing.assert_array_equal(a, b)
+    assert hit.stats()["hit"] is True
+
+def test_frames_over_budget_are_not_cached(tmp_path):
+    video = str(tmp_path / "clip.avi")
+    write_video(video)
+    frame_bytes = 64 * 48 * 3
+    cache = FrameCache(str(tmp_path / "cache"), max_bytes=3 * frame_bytes)
+    frames = iter(cache.open(video, backend="opencv"))
+    for _ in range(3):
+        next(frames)
+    tmp_dirs = [d for d in os.listdir(cache.root) if d.startswith(TMP_PREFIX)]
+    assert len(tmp_dirs) == 1
+    next(frames)  # the fourth frame passes the budget: writing stops and the temp entry goes
+    assert not os.path.exists(os.path.join(cache.root, tmp_dirs[0]))
+    assert len(list(frames)) == 8  # decoding carries on without the cache
+    assert cache.entries() == []
+    assert os.listdir(cache.root) == []
+    assert not cache.open(video, backend="opencv").hit
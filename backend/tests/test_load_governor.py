@@ -0,0 +1,46 @@
+from load_governor import LoadGovernor
+
+LEVELS = [{"imgsz": 640}, {"imgsz": 480}, {"imgsz": 320}]
+
+def make_governor(**kwargs):
+    kwargs.setdefault("max_queue", 2)
+    kwargs.setdefault("target_latency", 1.0)
+    kwargs.setdefault("step_interval", 0.0)
+    return LoadGovernor(levels=LEVELS, **kwargs)
+
+def test_starts_at_full_quality():
+    assert make_governor().quality() == (0, LEVELS[0])
+
+def test_steps_down_when_queue_is_deep():
+    governor = make_governor()
+    governor.in_flight = 3
+    assert governor.quality()[0] == 1
+    assert governor.quality()[0] == 2
+    assert governor.quality()[0] == 2  # lowest level is the floor
+
+def test_steps_down_on_slow_p90():
+    governor = make_governor()
+    governor.latencies.extend([1.5] * 10)
+    assert governor.quality()[0] == 1
+    assert len(governor.latencies) == 0  # samples from the old level are dropped
+
+def test_steps_up_only_with_enough_fast_samples():
+    governor = make_governor()
+    governor.level = 2
+    governor.latencies.extend([0.1] * 4)
+    assert governor.quality()[0] == 2
+    governor.latencies.append(0.1)
+    assert governor.quality()[0] == 1
+
+def test_step_interval_limits_level_changes():
+    governor = make_governor(step_interval=60.0)
+    governor.in_flight = 3
+    assert governor.quality()[0] == 1
+    assert governor.quality()[0] == 1
+
+def test_track_records_latency_and_in_flight():
+    governor = make_governor()
+    with governor.track():
+        assert governor.in_flight == 1
+    assert governor.in_flight == 0
+    assert len(governor.latencies) == 1
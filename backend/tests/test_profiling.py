@@ -0,0 +1,51 @@
+import threading
+import profiling
+from profiling import Trace, span
+
+class Conn:
+    def __init__(self, token):
+        self.headers = {"x-admin-token": token} if token is not None else {}
+
+def test_is_admin_checks_the_token(monkeypatch):
+    monkeypatch.setattr(profiling, "PROFILING_ENABLED", True)
+    monkeypatch.setattr(profiling, "PROFILING_TOKEN", "secret")
+    assert profiling.is_admin(Conn("secret"))
+    assert not profiling.is_admin(Conn("wrong"))
+    assert not profiling.is_admin(Conn(None))
+    assert not profiling.is_admin(Conn("sécret"))  # non-ASCII must not raise
+
+def test_is_admin_is_false_when_disabled(monkeypatch):
+    monkeypatch.setattr(profiling, "PROFILING_ENABLED", False)
+    monkeypatch.setattr(profiling, "PROFILING_TOKEN", "")
+    assert not profiling.is_admin(Conn(""))
+
+def test_span_is_a_no_op_without_a_trace():
+    assert span("yolo") is span("age")
+
+def test_spans_nest_and_fold_to_self_time():
+    trace = Trace("GET /detect")
+    tokens = trace.activate()
+    try:
+        with span("request"):
+            with span("yolo"):
+                pass
+            with span("age"):
+                pass
+    finally:
+        Trace.deactivate(tokens)
+    stacks = trace.folded()
+    assert set(stacks) == {"request", "request;yolo", "request;age"}
+    assert set(trace.summary()["spans"]) == {"request", "yolo", "age"}
+    assert span("after") is span("again")  # deactivated
+
+def test_sample_stacks_clamps_the_interval():
+    stop = threading.Event()
+    worker = threading.Thread(target=stop.wait, name="idle-worker")
+    worker.start()
+    try:
+        stacks = profiling.sample_stacks(0.05, interval=0)
+    finally:
+        stop.set()
+        worker.join()
+    samples = sum(count for stack, count in stacks.items() if stack.startswith("idle-worker;"))
+    assert 0 < samples <= 0.05 / profiling.PROFILE_MIN_INTERVAL + 1
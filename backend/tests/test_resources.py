@@ -0,0 +1,63 @@
+import os
+import json
+import threading
+
+import pytest
+
+import resources
+
+
+def test_parse_cpu_sets():
+    assert resources.parse_cpu_sets(None) == []
+    assert resources.parse_cpu_sets("") == []
+    assert resources.parse_cpu_sets("0-3") == [{0, 1, 2, 3}]
+    assert resources.parse_cpu_sets("0-3,8;4-7,9") == [{0, 1, 2, 3, 8}, {4, 5, 6, 7, 9}]
+    assert resources.parse_cpu_sets(" 2 , 5 ;; 6") == [{2, 5}, {6}]
+
+
+def test_default_budget_splits_cores_between_workers():
+    budget = resources.default_budget(cpus=8, workers=2)
+    assert budget["torch_intra_threads"] == 4
+    assert budget["ort_intra_threads"] == 4
+    assert budget["opencv_threads"] == 2
+    assert resources.default_budget(cpus=1, workers=4)["tf_intra_threads"] == 1
+
+
+def test_load_budget_overlays_file_then_env(tmp_path, monkeypatch):
+    path = tmp_path / "resources.json"
+    path.write_text(json.dumps({"ort_intra_threads": 3, "opencv_threads": 2, "unknown": 1}))
+    monkeypatch.setenv("OPENCV_THREADS", "5")
+    monkeypatch.setenv("INFERENCE_CPUS", "0-1")
+    budget = resources.load_budget(str(path))
+    assert budget["ort_intra_threads"] == 3
+    assert budget["opencv_threads"] == 5
+    assert budget["inference_cpus"] == "0-1"
+    assert "unknown" not in budget
+
+
+def test_worker_env():
+    env = resources.worker_env(0)
+    assert env["TORCH_INTRA_THREADS"] == env["ORT_INTRA_THREADS"] == "1"
+    assert env["OPENCV_THREADS"] == "1"
+
+
+@pytest.mark.skipif(not hasattr(os, "sched_setaffinity"), reason="no CPU affinity API")
+def test_pin_process_covers_threads_started_afterwards():
+    original = os.sched_getaffinity(0)
+    cpu = min(original)
+    seen = []
+    try:
+        assert resources.pin_process({"inference_cpus": str(cpu)})
+        thread = threading.Thread(target=lambda: seen.append(os.sched_getaffinity(0)))
+        thread.start()
+        thread.join()
+    finally:
+        os.sched_setaffinity(0, original)
+    assert seen == [{cpu}]
+    assert not resources.pin_process({"inference_cpus": None})
+
+
+def test_worker_pinning_only_for_several_core_sets():
+    assert resources.inference_worker_init({"inference_cpus": None}) is None
+    assert resources.inference_worker_init({"inference_cpus": "0-3"}) is None
+    assert callable(resources.inference_worker_init({"inference_cpus": "0-1;2-3"}))
@@ -0,0 +1,91 @@
+import time
+import threading
+import pytest
+from scheduler import FairScheduler, IDLE_CLIENT_SECONDS
+
+def noop():
+    return None
+
+def dispatch_order(scheduler, n):
+    # Dispatch and immediately complete n tasks with the estimated cost, without worker threads
+    order = []
+    for _ in range(n):
+        with scheduler.cond:
+            client, task = scheduler._next_task()
+            client.in_flight -= 1
+        order.append((client.client_id, task.request_class))
+    return order
+
+def test_interactive_clients_get_their_class_weight_share():
+    scheduler = FairScheduler(workers=0)
+    scheduler.mode_cost["object"] = 1.0
+    for _ in range(20):
+        scheduler.submit("phone", "interactive", "object", noop)
+        scheduler.submit("batch", "bulk", "object", noop)
+    order = dispatch_order(scheduler, 10)
+    assert sum(1 for client, _ in order if client == "phone") == 8  # 4:1 weights
+
+def test_weight_is_charged_per_task_not_per_client():
+    scheduler = FairScheduler(workers=0)
+    scheduler.mode_cost["object"] = 1.0
+    scheduler.submit("host", "bulk", "object", noop)
+    scheduler.submit("host", "interactive", "object", noop)
+    dispatch_order(scheduler, 2)
+    # One bulk call costs 1.0, one interactive call 0.25, whatever was submitted last
+    assert scheduler.clients["host"].vtime == 1.25
+
+def test_returning_client_cannot_bank_credit():
+    scheduler = FairScheduler(workers=0)
+    scheduler.mode_cost["object"] = 1.0
+    for _ in range(5):
+        scheduler.submit("busy", "bulk", "object", noop)
+    dispatch_order(scheduler, 3)
+    scheduler.submit("late", "bulk", "object", noop)
+    assert scheduler.clients["late"].vtime == scheduler.clients["busy"].vtime
+
+def test_in_flight_limit_skips_busy_clients():
+    scheduler = FairScheduler(workers=0, max_in_flight=1)
+    scheduler.submit("a", "bulk", "object", noop)
+    scheduler.submit("a", "bulk", "object", noop)
+    with scheduler.cond:
+        client, _ = scheduler._next_task()
+        assert client.client_id == "a"
+        assert scheduler._next_task() == (None, None)
+
+def test_worker_runs_tasks_and_records_stats():
+    scheduler = FairScheduler(workers=1)
+    futures = [scheduler.submit("a", "interactive", "face", lambda i=i: i * 2) for i in range(5)]
+    assert [f.result(timeout=5) for f in futures] == [0, 2, 4, 6, 8]
+    stats = scheduler.stats()
+    assert stats["clients"]["a"]["served"] == {"interactive": 5}
+    assert "face" in stats["mode_cost"]
+
+def test_errors_propagate_to_the_caller():
+    scheduler = FairScheduler(workers=1)
+
+    def fail():
+        raise ValueError("boom")
+    with pytest.raises(ValueError, match="boom"):
+        scheduler.submit("a", "bulk", "object", fail).result(timeout=5)
+
+def test_idle_clients_are_pruned_on_submit():
+    scheduler = FairScheduler(workers=0)
+    scheduler.submit("old", "bulk", "object", noop)
+    dispatch_order(scheduler, 1)
+    scheduler.clients["old"].last_seen = time.monotonic() - IDLE_CLIENT_SECONDS - 1
+    scheduler.last_prune = 0.0
+    scheduler.submit("new", "bulk", "object", noop)
+    assert "old" not in scheduler.clients
+
+def test_worker_init_runs_on_each_worker():
+    seen = []
+    lock = threading.Lock()
+
+    def init(index):
+        with lock:
+            seen.append(index)
+    FairScheduler(workers=2, worker_init=init)
+    deadline = time.monotonic() + 5
+    while len(seen) < 2 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert sorted(seen) == [0, 1]
@@ -0,0 +1,100 @@
+import shutil
+import cv2
+import numpy as np
+import pytest
+from video_decoder import DECODE_SEEK_STRIDE, open_decoder, pyav_available, resolve_backend
+
+FRAMES = 120
+FPS = 30
+GOP = 10  # keyframe interval of the generated clip
+SIZE = (64, 48)
+
+def available_backends():
+    backends = ["opencv"]
+    if pyav_available():
+        backends.append("pyav")
+    if shutil.which("ffmpeg") and shutil.which("ffprobe"):
+        backends.append("ffmpeg")
+    return backends
+
+def level(i):
+    return 2 * i  # each frame is flat gray at this level, so content identifies the frame
+
+@pytest.fixture(scope="module")
+def clip(tmp_path_factory):
+    # H.264 with a fixed GOP when PyAV can encode it, else MJPEG, where every frame is a keyframe
+    directory = tmp_path_factory.mktemp("clip")
+    if pyav_available():
+        import av
+        path = str(directory / "clip.mp4")
+        with av.open(path, "w") as container:
+            stream = container.add_stream("libx264", rate=FPS)
+            stream.width, stream.height = SIZE
+            stream.pix_fmt = "yuv420p"
+            stream.options = {"g": str(GOP), "keyint_min": str(GOP), "sc_threshold": "0", "bf": "0"}
+            for i in range(FRAMES):
+                image = np.full((SIZE[1], SIZE[0], 3), level(i), dtype=np.uint8)
+                for packet in stream.encode(av.VideoFrame.from_ndarray(image, format="bgr24")):
+                    container.mux(packet)
+            for packet in stream.encode():
+                container.mux(packet)
+        return path, GOP
+    path = str(directory / "clip.avi")
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*"MJPG"), FPS, SIZE)
+    for i in range(FRAMES):
+        writer.write(np.full((SIZE[1], SIZE[0], 3), level(i), dtype=np.uint8))
+    writer.release()
+    return path, 1
+
+def decode(path, backend, **kwargs):
+    decoder = open_decoder(path, backend, **kwargs)
+    frames = [(n, f.copy()) for n, f in decoder]
+    return decoder, frames
+
+def assert_content_matches(frames):
+    for frame_num, frame in frames:
+        assert abs(int(frame.mean()) - level(frame_num)) <= 8, frame_num
+
+@pytest.mark.parametrize("backend", available_backends())
+def test_every_frame(clip, backend):
+    decoder, frames = decode(clip[0], backend)
+    assert [n for n, _ in frames] == list(range(FRAMES))
+    assert decoder.source_frames == FRAMES
+    assert decoder.fps == pytest.approx(FPS, rel=0.01)
+    assert_content_matches(frames)
+
+@pytest.mark.parametrize("backend", available_backends())
+@pytest.mark.parametrize("stride", [5, DECODE_SEEK_STRIDE])
+def test_stride(clip, backend, stride):
+    decoder, frames = decode(clip[0], backend, stride=stride)
+    assert [n for n, _ in frames] == list(range(0, FRAMES, stride))
+    assert decoder.source_frames == FRAMES
+    assert_content_matches(frames)
+
+@pytest.mark.parametrize("backend", available_backends())
+def test_scale(clip, backend):
+    decoder, frames = decode(clip[0], backend, stride=40, max_side=32)
+    assert decoder.scale == pytest.approx(0.5)
+    assert all(f.shape == (24, 32, 3) for _, f in frames)
+    decoder, frames = decode(clip[0], backend, stride=40, max_side=640)
+    assert decoder.scale == 1.0
+    assert frames[0][1].shape == (SIZE[1], SIZE[0], 3)
+
+@pytest.mark.parametrize("backend", available_backends())
+def test_keyframes_only(clip, backend):
+    path, gop = clip
+    decoder, frames = decode(path, backend, keyframes_only=True)
+    numbers = [n for n, _ in frames]
+    if backend == "opencv":
+        assert numbers == list(range(0, FRAMES, FPS))  # no frame types: one frame per second
+    else:
+        assert numbers == list(range(0, FRAMES, gop))
+    assert decoder.source_frames == FRAMES
+    assert_content_matches(frames)
+
+def test_resolve_backend():
+    assert resolve_backend(0) == "opencv"
+    assert resolve_backend("clip.mp4", "opencv") == "opencv"
+    assert resolve_backend("clip.mp4") in available_backends()
+    with pytest.raises(ValueError):
+        resolve_backend("clip.mp4", "gstreamer")
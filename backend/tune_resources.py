@@ -0,0 +1,154 @@
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from resources import RESOURCE_CONFIG, cpu_count, default_budget
+from batch_process import IMAGE_EXTS, collect_files
+
+# Sweeps thread budgets over a benchmark workload and recommends the best one for this host.
+# Every trial runs in a fresh process, because OpenMP, TensorFlow and ONNX Runtime only read
+# their thread settings when they start up.
+#
+#   python tune_resources.py /data/sample_images --mode face --requests 64 --concurrency 4
+
+logger = logging.getLogger("tune_resources")
+
+THREAD_ENV = ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS",
+              "TF_NUM_INTRAOP_THREADS", "TF_NUM_INTEROP_THREADS")
+
+# ================== Trial (child process) ==================
+def run_trial(args):
+    import app  # applies the budget from the environment and loads every model
+
+    paths = [path for path in collect_files(args.inputs) if os.path.splitext(path)[1].lower() in IMAGE_EXTS]
+    if not paths:
+        raise SystemExit("No images found")
+    images = []
+    for path in paths[:args.requests]:
+        with open(path, "rb") as f:
+            images.append(f.read())
+    model = app.object_model if args.mode == "object" else app.face_model
+
+    def request(i):
+        start = time.perf_counter()
+        frame = app.decode_image(images[i % len(images)])
+        app.run_scheduled(f"bench-{i % args.concurrency}", "interactive", args.mode,
+                          app.process_frame, frame, model, args.mode)
+        return time.perf_counter() - start
+
+    for i in range(args.warmup):
+        request(i)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        latencies = sorted(pool.map(request, range(args.requests)))
+    elapsed = time.perf_counter() - start
+    print(json.dumps({
+        "throughput": round(len(latencies) / elapsed, 4),
+        "latency_p50": round(latencies[len(latencies) // 2], 4),
+        "latency_p95": round(latencies[int(0.95 * (len(latencies) - 1))], 4),
+    }))
+
+# ================== Sweep (parent process) ==================
+def candidate_budgets(cpus, try_pinning=False):
+    intra_options = sorted({n for n in (1, 2, cpus // 4, cpus // 2, cpus) if 1 <= n <= cpus})
+    opencv_options = sorted({1, max(1, min(4, cpus // 4))})
+    candidates = []
+    for intra in intra_options:
+        for interop in (1, 2):
+            for opencv in opencv_options:
+                budget = default_budget(cpus)
+                budget.update({
+                    "torch_intra_threads": intra, "tf_intra_threads": intra, "ort_intra_threads": intra,
+                    "torch_interop_threads": interop, "tf_inter_threads": interop,
+                    "opencv_threads": opencv,
+                })
+                candidates.append(budget)
+                if try_pinning and intra < cpus:
+                    pinned = dict(budget, inference_cpus=f"0-{intra - 1}")
+                    candidates.append(pinned)
+    return candidates
+
+def trial_env(budget):
+    env = {k: v for k, v in os.environ.items() if k not in THREAD_ENV}
+    for key, value in budget.items():
+        env.pop(key.upper(), None)
+        if value is not None:
+            env[key.upper()] = str(value)
+    env["RESOURCE_CONFIG"] = ""  # measure exactly this budget, not the installed one
+    env["LOG_LEVEL"] = "WARNING"
+    return env
+
+def measure(budget, args):
+    cmd = [sys.executable, os.path.abspath(__file__), *args.inputs, "--trial", "--mode", args.mode,
+           "--requests", str(args.requests), "--concurrency", str(args.concurrency), "--warmup", str(args.warmup)]
+    proc = subprocess.run(cmd, env=trial_env(budget), capture_output=True, text=True, timeout=args.trial_timeout)
+    if proc.returncode != 0:
+        raise RuntimeError(proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else f"exit code {proc.returncode}")
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+def pick_best(results, objective, max_p95=None):
+    eligible = [r for r in results if max_p95 is None or r["latency_p95"] <= max_p95] or results
+    if objective == "latency":
+        return min(eligible, key=lambda r: (r["latency_p95"], -r["throughput"]))
+    return max(eligible, key=lambda r: (r["throughput"], -r["latency_p95"]))
+
+def describe(budget):
+    return (f"intra={budget['torch_intra_threads']} interop={budget['torch_interop_threads']} "
+            f"opencv={budget['opencv_threads']} cpus={budget['inference_cpus'] or 'all'}")
+
+def run(args):
+    cpus = cpu_count()
+    candidates = candidate_budgets(cpus, args.try_pinning)[:args.max_trials]
+    logger.info(f"{cpus} CPUs, {len(candidates)} budgets to try ({args.requests} {args.mode} requests, "
+                f"concurrency {args.concurrency})")
+    results = []
+    for i, budget in enumerate(candidates, 1):
+        try:
+            metrics = measure(budget, args)
+        except (RuntimeError, ValueError, subprocess.TimeoutExpired) as e:
+            logger.error(f"[{i}/{len(candidates)}] {describe(budget)} failed: {e}")
+            continue
+        results.append({"budget": budget, **metrics})
+        logger.info(f"[{i}/{len(candidates)}] {describe(budget)}: {metrics['throughput']:.2f} req/s, "
+                    f"p50 {metrics['latency_p50']:.3f}s, p95 {metrics['latency_p95']:.3f}s")
+    if not results:
+        raise SystemExit("Every trial failed")
+
+    best = pick_best(results, args.objective, args.max_p95)
+    logger.info(f"Recommended ({args.objective}): {describe(best['budget'])} -> {best['throughput']:.2f} req/s, "
+                f"p95 {best['latency_p95']:.3f}s")
+    if args.dry_run:
+        print(json.dumps(best["budget"], indent=2))
+        return
+    with open(args.write, "w") as f:
+        json.dump(best["budget"], f, indent=2)
+    logger.info(f"Wrote {args.write}; the backend picks it up on its next start")
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Sweep CPU thread budgets over a benchmark workload.")
+    parser.add_argument("inputs", nargs="+", help="Directories or files of benchmark images")
+    parser.add_argument("--mode", choices=["object", "face"], default="face")
+    parser.add_argument("--requests", type=int, default=64, help="Requests per trial")
+    parser.add_argument("--concurrency", type=int, default=4, help="Concurrent simulated clients")
+    parser.add_argument("--warmup", type=int, default=3, help="Unmeasured requests before each trial")
+    parser.add_argument("--objective", choices=["throughput", "latency"], default="throughput")
+    parser.add_argument("--max-p95", type=float, help="Only recommend budgets under this p95 latency (seconds)")
+    parser.add_argument("--try-pinning", action="store_true", help="Also try pinning inference to a core set")
+    parser.add_argument("--max-trials", type=int, default=40)
+    parser.add_argument("--trial-timeout", type=float, default=1800.0, help="Seconds before a trial is abandoned")
+    parser.add_argument("--write", default=RESOURCE_CONFIG or "resources.json", help="Where to write the recommended budget")
+    parser.add_argument("--dry-run", action="store_true", help="Print the recommendation without writing it")
+    parser.add_argument("--trial", action="store_true", help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.trial:
+        run_trial(args)
+    else:
+        logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+        run(args)
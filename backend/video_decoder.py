@@ -0,0 +1,289 @@
+import os
+import json
+import shutil
+import logging
+import tempfile
+import functools
+import subprocess
+import cv2
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# ================== Configuration ==================
+DECODE_BACKEND = os.environ.get("VIDEO_DECODER", "auto")  # auto | opencv | pyav | ffmpeg
+DECODE_THREADS = int(os.environ.get("DECODE_THREADS", "0"))  # 0 lets the decoder pick
+DECODE_SEEK_STRIDE = int(os.environ.get("DECODE_SEEK_STRIDE", "60"))  # seek instead of decoding through gaps this long
+
+# ================== Helpers ==================
+def downscale_factor(shape, max_side):
+    h, w = shape[:2]
+    if not max_side or max(h, w) <= max_side:
+        return 1.0
+    return max_side / float(max(h, w))
+
+def scaled_size(width, height, scale):
+    return int(round(width * scale)), int(round(height * scale))
+
+def resize_frame(frame, scale):
+    if scale == 1.0:
+        return frame
+    h, w = frame.shape[:2]
+    return cv2.resize(frame, scaled_size(w, h, scale), interpolation=cv2.INTER_AREA)
+
+@functools.lru_cache(maxsize=None)
+def ffmpeg_has_fps_mode():
+    # -fps_mode replaced -vsync in ffmpeg 5.1; older builds reject it
+    try:
+        out = subprocess.run(["ffmpeg", "-hide_banner", "-h", "full"], capture_output=True, text=True).stdout
+    except OSError:
+        return False
+    return "-fps_mode" in out
+
+def pyav_available():
+    try:
+        import av  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+# ================== Decoders ==================
+class BaseDecoder:
+    """Yields (frame_num, BGR frame) for every `stride`-th frame, or for keyframes only.
+
+    Frames are scaled so the longest side is at most `max_side`; `scale` is the factor applied,
+    so callers can map coordinates back onto the source video.
+    """
+
+    def __init__(self, source, stride=1, max_side=None, keyframes_only=False, threads=DECODE_THREADS):
+        self.source = source
+        self.stride = max(1, int(stride))
+        self.max_side = max_side
+        self.keyframes_only = keyframes_only
+        self.threads = threads
+        self.fps = 0.0
+        self.scale = 1.0
+        self.source_frames = 0
+
+    def __iter__(self):
+        raise NotImplementedError
+
+class OpenCVDecoder(BaseDecoder):
+    # Skipped frames are only grabbed (decoded, never converted or resized)
+
+    def __iter__(self):
+        params = [cv2.CAP_PROP_N_THREADS, self.threads] if self.threads and hasattr(cv2, "CAP_PROP_N_THREADS") else []
+        cap = cv2.VideoCapture(self.source, cv2.CAP_ANY, params) if params else cv2.VideoCapture(self.source)
+        if not cap.isOpened():
+            raise IOError(f"Unable to open video source: {self.source}")
+        self.fps = float(cap.get(cv2.CAP_PROP_FPS) or 0.0)
+        stride = self.stride
+        if self.keyframes_only:
+            # OpenCV cannot see frame types; approximate a coarse scan with one frame per second
+            stride = max(1, int(round(self.fps))) if self.fps else stride
+            logger.debug("OpenCV decoder has no keyframe access, sampling one frame per second")
+        width, height = cap.get(cv2.CAP_PROP_FRAME_WIDTH), cap.get(cv2.CAP_PROP_FRAME_HEIGHT)
+        scale = downscale_factor((height, width), self.max_side) if width and height else None
+        frame_num = 0
+        try:
+            while True:
+                if frame_num % stride:
+                    if not cap.grab():
+                        break
+                    frame_num += 1
+                    continue
+                ret, frame = cap.read()
+                if not ret:
+                    break
+                if scale is None:
+                    scale = downscale_factor(frame.shape, self.max_side)
+                self.scale = scale
+                yield frame_num, resize_frame(frame, scale)
+                frame_num += 1
+        finally:
+            self.source_frames = frame_num
+            cap.release()
+
+class PyAVDecoder(BaseDecoder):
+    # Multi-threaded libavcodec decode with scaling in swscale, NONKEY frame skipping inside
+    # the decoder, and demuxer-level seeks across long gaps between sampled frames
+
+    def __iter__(self):
+        import av
+        try:
+            container = av.open(self.source)
+        except Exception as e:
+            raise IOError(f"Unable to open video source: {self.source} ({e})")
+        try:
+            stream = container.streams.video[0]
+            stream.thread_type = "AUTO"
+            if self.threads:
+                stream.codec_context.thread_count = self.threads
+            if self.keyframes_only:
+                stream.codec_context.skip_frame = "NONKEY"
+            rate = stream.average_rate or stream.guessed_rate
+            self.fps = float(rate) if rate else 0.0
+            width, height = stream.codec_context.width, stream.codec_context.height
+            self.scale = downscale_factor((height, width), self.max_side)
+            out_w, out_h = scaled_size(width, height, self.scale)
+            start_pts = stream.start_time or 0
+            # The sparse paths below never reach the last frame, so the total comes from the container
+            self.source_frames = self.frame_count(container, stream)
+
+            def to_bgr(frame):
+                return frame.reformat(width=out_w, height=out_h, format="bgr24").to_ndarray()
+
+            def frame_index(frame, fallback):
+                if frame.pts is None or not self.fps:
+                    return fallback
+                return int(round(float((frame.pts - start_pts) * stream.time_base) * self.fps))
+
+            if self.keyframes_only:
+                for i, frame in enumerate(container.decode(stream)):
+                    frame_num = frame_index(frame, i)
+                    self.source_frames = max(self.source_frames, frame_num + 1)
+                    yield frame_num, to_bgr(frame)
+            elif self.stride >= DECODE_SEEK_STRIDE and self.fps:
+                target = 0
+                while True:
+                    container.seek(start_pts + int(target / self.fps / stream.time_base), stream=stream, backward=True)
+                    found = None
+                    for i, frame in enumerate(container.decode(stream)):
+                        frame_num = frame_index(frame, target + i)
+                        if frame_num >= target:
+                            found = (frame_num, frame)
+                            break
+                    if found is None:
+                        break
+                    frame_num, frame = found
+                    self.source_frames = max(self.source_frames, frame_num + 1)
+                    yield frame_num, to_bgr(frame)
+                    target = (frame_num // self.stride + 1) * self.stride
+            else:
+                for frame_num, frame in enumerate(container.decode(stream)):
+                    self.source_frames = max(self.source_frames, frame_num + 1)
+                    if frame_num % self.stride == 0:
+                        yield frame_num, to_bgr(frame)
+        finally:
+            container.close()
+
+    def frame_count(self, container, stream):
+        # Header frame count when the muxer wrote one, else duration x fps
+        import av
+        if stream.frames:
+            return stream.frames
+        if stream.duration and stream.time_base and self.fps:
+            return int(round(float(stream.duration * stream.time_base) * self.fps))
+        if container.duration and self.fps:
+            return int(round(container.duration / av.time_base * self.fps))
+        return 0
+
+class FFmpegDecoder(BaseDecoder):
+    # ffmpeg subprocess: frame selection and scaling happen inside ffmpeg's filter graph,
+    # so only the sampled frames are converted and piped back as raw BGR
+
+    def probe(self):
+        cmd = ["ffprobe", "-v", "error", "-select_streams", "v:0", "-count_packets",
+               "-show_entries", "stream=width,height,avg_frame_rate,r_frame_rate,nb_read_packets,start_time",
+               "-of", "json", self.source]
+        try:
+            info = json.loads(subprocess.run(cmd, capture_output=True, check=True).stdout)["streams"][0]
+        except (subprocess.CalledProcessError, KeyError, IndexError, ValueError) as e:
+            raise IOError(f"Unable to open video source: {self.source} ({e})")
+        num, _, den = (info.get("avg_frame_rate") or info.get("r_frame_rate") or "0/1").partition("/")
+        fps = float(num) / float(den or 1) if float(den or 1) else 0.0
+        try:
+            self.start_time = float(info.get("start_time") or 0.0)
+        except ValueError:  # "N/A"
+            self.start_time = 0.0
+        return int(info["width"]), int(info["height"]), fps, int(info.get("nb_read_packets") or 0)
+
+    def keyframe_numbers(self):
+        # Demux-only pass: packet flags tell us which frames are keyframes
+        cmd = ["ffprobe", "-v", "error", "-select_streams", "v:0", "-show_entries", "packet=pts_time,flags",
+               "-of", "csv=p=0", self.source]
+        out = subprocess.run(cmd, capture_output=True, text=True).stdout
+        times = []
+        for line in out.splitlines():
+            pts_time, _, flags = line.partition(",")
+            if "K" in flags and pts_time not in ("", "N/A"):
+                times.append(float(pts_time))
+        return [int(round((t - self.start_time) * self.fps)) for t in sorted(times)]
+
+    def __iter__(self):
+        width, height, self.fps, self.source_frames = self.probe()
+        self.scale = downscale_factor((height, width), self.max_side)
+        out_w, out_h = scaled_size(width, height, self.scale)
+
+        cmd = ["ffmpeg", "-v", "error", "-nostdin"]
+        if self.threads:
+            cmd += ["-threads", str(self.threads)]
+        if self.keyframes_only:
+            cmd += ["-skip_frame", "nokey"]
+        cmd += ["-i", self.source]
+        filters = []
+        if not self.keyframes_only and self.stride > 1:
+            filters.append(f"select=not(mod(n\\,{self.stride}))")
+        if self.scale != 1.0:
+            filters.append(f"scale={out_w}:{out_h}")
+        if filters:
+            cmd += ["-vf", ",".join(filters)]
+        cmd += ["-fps_mode" if ffmpeg_has_fps_mode() else "-vsync", "passthrough"]
+        cmd += ["-an", "-f", "rawvideo", "-pix_fmt", "bgr24", "pipe:1"]
+
+        frame_numbers = self.keyframe_numbers() if self.keyframes_only else None
+        # stderr goes to a file rather than a pipe nobody drains while frames are read
+        with tempfile.TemporaryFile() as stderr:
+            proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=stderr, bufsize=out_w * out_h * 3 * 2)
+            finished = False
+            try:
+                i = 0
+                while True:
+                    frame = np.empty((out_h, out_w, 3), dtype=np.uint8)
+                    if not self._read_exact(proc.stdout, frame):
+                        break
+                    if frame_numbers is not None:
+                        frame_num = frame_numbers[i] if i < len(frame_numbers) else (frame_numbers[-1] if frame_numbers else 0) + i
+                    else:
+                        frame_num = i * self.stride
+                    yield frame_num, frame
+                    i += 1
+                finished = True
+            finally:
+                if not finished:
+                    proc.kill()  # the consumer stopped early
+                proc.stdout.close()
+                returncode = proc.wait()
+            if returncode != 0:
+                stderr.seek(0)
+                tail = stderr.read().decode(errors="replace").strip().splitlines()[-3:]
+                raise IOError(f"ffmpeg failed decoding {self.source} (exit code {returncode}): {' | '.join(tail)}")
+
+    @staticmethod
+    def _read_exact(stream, frame):
+        view = memoryview(frame).cast("B")
+        got = 0
+        while got < len(view):
+            n = stream.readinto(view[got:])
+            if not n:
+                return False
+            got += n
+        return True
+
+DECODERS = {"opencv": OpenCVDecoder, "pyav": PyAVDecoder, "ffmpeg": FFmpegDecoder}
+
+def resolve_backend(source, backend=DECODE_BACKEND):
+    if backend == "auto":
+        if not isinstance(source, str):
+            return "opencv"  # camera indices
+        if pyav_available():
+            return "pyav"
+        if shutil.which("ffmpeg") and shutil.which("ffprobe") and "://" not in source:
+            return "ffmpeg"
+        return "opencv"
+    if backend not in DECODERS:
+        raise ValueError(f"Unknown video decoder '{backend}'. Use one of: auto, {', '.join(DECODERS)}")
+    return backend
+
+def open_decoder(source, backend=DECODE_BACKEND, **kwargs):
+    return DECODERS[resolve_backend(source, backend)](source, **kwargs)